@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark ishares_eqy_fdf_parse.py against the checked-in csv_files corpus.
+
+Replays every FDF file through parse_data, transpose, format_date,
+format_header and merge_holdings, then through the full main() path, one
+run per file and grain. Each stage runs in a fresh interpreter, so its
+peak RSS, and that of any worker processes it starts, is its own. Reports
+files/s, rows/s and peak RSS per stage, and compares them with a stored
+baseline JSON.
+
+Usage:
+    python bench_ishares_eqy_fdf_parse.py                  # report
+    python bench_ishares_eqy_fdf_parse.py --save-baseline  # store baseline
+"""
+
+
+import os
+import sys
+import glob
+import json
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from time import perf_counter
+
+import ishares_eqy_fdf_parse as fdf
+
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CORPUS = os.path.join(SCRIPT_DIRECTORY, '..', 'csv_files', '2019012*_files',
+                      '*FDF.*')
+BASELINE = os.path.join(SCRIPT_DIRECTORY, 'bench_baseline.json')
+METRICS_FILENAME = 'metrics.jsonl'
+TRANSPOSED_SECTIONS = ['Fund Level', 'Basket Level', 'Swaps']
+HEADER_SECTIONS = ['Spreads', 'Allocation Details', 'FX Forwards']
+STAGES = (['parse_data', 'transpose', 'format_date', 'format_header',
+           'merge_holdings'] + ['main:' + grain for grain in fdf.GRAINS])
+
+
+def parse_args(argv=None):
+    """Parses user provided arguments with argparse's ArgumentParser."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--corpus', default=CORPUS,
+                        help='Glob pattern of FDF files to replay')
+    parser.add_argument('-b', '--baseline', default=BASELINE,
+                        help='Baseline JSON to compare against')
+    parser.add_argument('-s', '--save-baseline', action='store_true',
+                        help='Store this run as the new baseline')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Runs per stage, the fastest is reported')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='Allowed fractional slowdown before a stage is'
+                        ' reported as a regression')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Workers for the main() stages')
+    parser.add_argument('--stages', default='all',
+                        help='Comma separated stages to run, or "all"')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show warnings logged by the parser')
+    # Runs one stage and prints its result as JSON, see run_stage_process()
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+    """Returns the peak resident set size of this process in KB, or with
+    RUSAGE_CHILDREN that of its largest waited for child process."""
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB on Linux
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def load_corpus(pattern):
+    """Reads every file matching `pattern` the way main() does.
+
+    Returns:
+        `corpus`: A list of (inputfile, list of lines, names of the sections
+        the file contains)
+    """
+    inputfiles = sorted(glob.glob(pattern))
+    if not inputfiles:
+        sys.exit('no files found for corpus: {}'.format(pattern))
+    corpus = []
+    for inputfile in inputfiles:
+        with open(inputfile, mode='r', encoding='utf-8-sig') as infile:
+            lines = infile.read().split('\n')
+        # Section headers open the file or follow an empty line. The last
+        # section may be unterminated, which only matters if it is parsed
+        present = {line.strip() for previous, line in zip([''] + lines, lines)
+                   if previous.strip() == '' and line.strip()}
+        corpus.append((inputfile, lines, present))
+    return corpus
+
+
+def sections_of(corpus, names):
+    """Returns the rows of every section in `names` for every file, skipping
+    sections a file does not have (e.g. funds without FX Forwards)."""
+    sections = []
+    for _, lines, present in corpus:
+        index = fdf.SectionIndex(lines)
+        sections.append([index.parse_data(name, '') for name in names
+                         if name in present])
+    return sections
+
+
+def count(sections):
+    """Returns the number of rows in the output of sections_of()."""
+    return sum(len(rows) for file_sections in sections
+               for rows in file_sections)
+
+
+def stage_function(corpus, name):
+    """Builds the in-memory stage `name`, a (function, files, rows) tuple
+    where `function` replays the stage over the whole corpus and `rows` is
+    the number of input rows it consumes. Only the inputs of that stage
+    are prepared."""
+    if name == 'parse_data':
+        names = fdf.section_names(fdf.GRAINS)
+        return (lambda: [fdf.parse_data(lines, section, '')
+                         for _, lines, present in corpus
+                         for section in names if section in present],
+                len(corpus), sum(len(lines) for _, lines, _ in corpus))
+    if name == 'transpose':
+        transposed = sections_of(corpus, TRANSPOSED_SECTIONS)
+        return (lambda: [fdf.transpose(rows) for file_sections in transposed
+                         for rows in file_sections],
+                len(corpus), count(transposed))
+    if name == 'format_date':
+        dated = [[fdf.transpose(rows) for rows in file_sections]
+                 for file_sections in sections_of(corpus,
+                                                  TRANSPOSED_SECTIONS)]
+        return (lambda: [fdf.format_date(rows) for file_sections in dated
+                         for rows in file_sections],
+                len(corpus), count(dated))
+    if name == 'format_header':
+        headers = sections_of(corpus, HEADER_SECTIONS)
+        return (lambda: [fdf.format_header(rows) for file_sections in headers
+                         for rows in file_sections],
+                len(corpus), count(headers))
+    if name == 'merge_holdings':
+        holdings = sections_of(corpus, fdf.GRAINS['holdings'])
+        return (lambda: [fdf.merge_holdings(file_sections)
+                         for file_sections in holdings],
+                len(corpus), count(holdings))
+    raise ValueError('unknown stage: {}'.format(name))
+
+
+def seed_isin_cache(corpus, cache_path):
+    """Marks every fund in the corpus as verified in an ISIN cache, so the
+    main() stages make no query calls."""
+    lookup = fdf.IsinLookup(cache_path=cache_path)
+    try:
+        identities = [fdf.read_fund_identity(inputfile)
+                      for inputfile, _, _ in corpus]
+        lookup.store('name', {name: 'BENCHMARK' for name, _ in identities})
+    finally:
+        lookup.close()
+
+
+def main_function(corpus, grain, workers, workspace):
+    """Builds the full main() stage for one grain, a --batch run per input
+    file with a pre-seeded ISIN cache, run in a pool of `workers` processes.
+
+    Every file is written to an output of its own, as rows shared between
+    files (FX rates of the same day, empty swaps rows) would otherwise fail
+    the duplicate check of every file but the first. Files without the
+    grain's sections are left out. Any file that still fails is recorded in
+    the --metrics file at METRICS_FILENAME next to its output, see
+    failed_files().
+
+    Returns:
+        `function`, `files`, `rows`, `replays`: As stage_function(), and a
+        list extended with the directory of every replay
+    """
+    cache_path = os.path.join(workspace, 'isin.db')
+    seed_isin_cache(corpus, cache_path)
+    names = fdf.section_names([grain])
+    inputfiles = [(inputfile, len(lines)) for inputfile, lines, present
+                  in corpus if all(name in present for name in names)]
+    replays = []
+
+    def replay():
+        replays.append(tempfile.mkdtemp(dir=workspace))
+        argvs = []
+        for i, (inputfile, _) in enumerate(inputfiles):
+            outputdir = os.path.join(replays[-1], str(i))
+            os.mkdir(outputdir)
+            argvs.append(['-b', inputfile, '-g', grain,
+                          '-o', os.path.join(outputdir, fdf.OUTPUT_FILENAME
+                                             .format(grain)),
+                          '--isin-cache', cache_path, '--nomanifest',
+                          '--metrics', os.path.join(outputdir,
+                                                    METRICS_FILENAME)])
+        if workers == 1:
+            for argv in argvs:
+                run_main(argv)
+        else:
+            import multiprocessing
+            with multiprocessing.Pool(workers) as pool:
+                pool.map(run_main, argvs, chunksize=1)
+
+    return (replay, len(inputfiles),
+            sum(lines for _, lines in inputfiles), replays)
+
+
+def run_main(argv):
+    """Runs the parser's main() with `argv`, for main_function()."""
+    try:
+        fdf.main(argv)
+    except SystemExit:
+        # Raised once the file is processed if it failed
+        pass
+
+
+def failed_files(replay):
+    """Returns the number of files that failed in a replay of a main()
+    stage, from the --metrics files below the `replay` directory."""
+    failed = 0
+    for metrics_path in glob.glob(os.path.join(replay, '*',
+                                               METRICS_FILENAME)):
+        with open(metrics_path) as infile:
+            runs = [record for record in map(json.loads, infile)
+                    if record['record'] == 'run']
+        failed += runs[-1]['files'].get('failed', 0)
+    return failed
+
+
+def run_stage(function, files, rows, repeat):
+    """Times `function` and returns a result dict for the fastest run.
+
+    Peak RSS is that of the whole process, so this is meant to run in the
+    process of a single stage, see run_stage_process().
+    """
+    elapsed = min(timed(function) for _ in range(max(1, repeat)))
+    return {'seconds': round(elapsed, 6),
+            'files_per_second': round(files / elapsed, 2),
+            'rows_per_second': round(rows / elapsed, 2),
+            'peak_rss_kb': peak_rss_kb(),
+            'children_peak_rss_kb': peak_rss_kb(resource.RUSAGE_CHILDREN)}
+
+
+def run_child(args):
+    """Runs the single stage `args.run_stage` in this process and prints its
+    result dict as JSON."""
+    corpus = load_corpus(args.corpus)
+    with tempfile.TemporaryDirectory() as workspace:
+        if args.run_stage.startswith('main:'):
+            function, files, rows, replays = main_function(
+                corpus, args.run_stage[len('main:'):], args.workers,
+                workspace)
+        else:
+            function, files, rows = stage_function(corpus, args.run_stage)
+        result = run_stage(function, files, rows, args.repeat)
+        result['workers'] = args.workers
+        if args.run_stage.startswith('main:'):
+            result['failed_files'] = failed_files(replays[-1])
+    print(json.dumps(result))
+
+
+def run_stage_process(name, args):
+    """Runs stage `name` in a fresh interpreter and returns its result
+    dict. ru_maxrss never goes down, so a stage sharing a process with
+    earlier stages would report their peak instead of its own."""
+    command = [sys.executable, os.path.abspath(__file__),
+               '--run-stage', name, '-c', args.corpus,
+               '-r', str(args.repeat), '-w', str(args.workers)]
+    if args.verbose:
+        command.append('-v')
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def timed(function):
+    start = perf_counter()
+    function()
+    return perf_counter() - start
+
+
+def compare(results, baseline, tolerance):
+    """Compares results with a baseline.
+
+    Stages run with a different number of --workers than in the baseline
+    are not compared, nor are main() stages in which files failed, as they
+    would time the bailout path instead of the write path.
+
+    Returns:
+        `regressions`: A list of messages for stages whose throughput fell,
+        or peak RSS grew, by more than `tolerance`
+
+    Example:
+        compare({'a': {'files_per_second': 5, 'peak_rss_kb': 10}},
+                {'a': {'files_per_second': 10, 'peak_rss_kb': 10}}, 0.2)
+        >>> ['a: 5 files/s vs baseline 10 files/s']
+    """
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        expected = baseline[stage]
+        if result.get('workers') != expected.get('workers'):
+            continue
+        if result.get('failed_files') or expected.get('failed_files'):
+            continue
+        if (result['files_per_second']
+                < expected['files_per_second'] * (1 - tolerance)):
+            regressions.append('{}: {} files/s vs baseline {} files/s'
+                               .format(stage, result['files_per_second'],
+                                       expected['files_per_second']))
+        for key, label in (('peak_rss_kb', 'peak RSS'),
+                           ('children_peak_rss_kb', 'worker peak RSS')):
+            if key not in result or key not in expected:
+                continue
+            if result[key] > expected[key] * (1 + tolerance):
+                regressions.append('{}: {} KB {} vs baseline {} KB'
+                                   .format(stage, result[key], label,
+                                           expected[key]))
+    return regressions
+
+
+def main(argv=None):
+    """Runs the benchmark and reports results."""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING if args.verbose
+                        else logging.CRITICAL,
+                        format=fdf.LOG_FORMAT, datefmt=fdf.LOG_DATEFMT)
+    if args.run_stage:
+        run_child(args)
+        return 0
+
+    corpus = load_corpus(args.corpus)
+    print('corpus: {} files, {} lines'
+          .format(len(corpus), sum(len(lines) for _, lines, _ in corpus)))
+    stages = STAGES
+    if args.stages != 'all':
+        selected = args.stages.split(',')
+        stages = [name for name in stages if name in selected]
+
+    results = {}
+    print('{:<18} {:>10} {:>10} {:>12} {:>12} {:>12} {:>7}'
+          .format('stage', 'seconds', 'files/s', 'rows/s', 'peak RSS KB',
+                  'workers KB', 'failed'))
+    for name in stages:
+        results[name] = run_stage_process(name, args)
+        print('{:<18} {seconds:>10.3f} {files_per_second:>10.1f}'
+              ' {rows_per_second:>12.0f} {peak_rss_kb:>12}'
+              ' {children_peak_rss_kb:>12} {:>7}'
+              .format(name, results[name].get('failed_files', ''),
+                      **results[name]))
+
+    if args.save_baseline:
+        with open(args.baseline, mode='w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+        print('baseline saved to {}'.format(args.baseline))
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print('no baseline at {}, run with --save-baseline to store one'
+              .format(args.baseline))
+        return 0
+    with open(args.baseline) as infile:
+        baseline = json.load(infile)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION', regression)
+    if not regressions:
+        print('no regressions against {}'.format(args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,14 +14,28 @@ import sys
 import os
 import argparse
 import logging
-
-from subprocess import run
+import codecs
+import csv
+import glob
+import hashlib
+import json
+import mmap
+import re
+import shutil
+import sqlite3
+
+from subprocess import run, PIPE
 from pathlib import Path
 from datetime import datetime
 from itertools import zip_longest
-from time import time
+from time import time, perf_counter
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
 
-import pandas as pd
+# Heavy modules (numpy, pyarrow, multiprocessing, asyncio, http.server) are
+# imported inside the functions that need them, so runs that never touch them
+# do not pay for the import
 
 
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
@@ -37,6 +51,56 @@ GRAINS = {
     'forwards': 'FX Forwards',
     'swaps': 'Swaps'
     }
+OUTPUT_FILENAME = 'isharesfdfeqy_{}.ff'
+OUTPUT_DATASET = 'isharesfdfeqy_{}'
+OUTPUT_FORMATS = {'ff': '.ff', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Typing for columnar output formats. Columns ending in '_date' are stored
+# as dates, the columns below as float64, and everything else as strings
+NUMERIC_COLUMNS = frozenset([
+    'total_nav_per_share', 'distribution_per_share', 'fund_size',
+    'shares_outstanding', 'baskets_outstanding',
+    'share_class_apportionment_ratio', 'shares_per_basket_(pnu)',
+    'projected_transaction_fee', 'confirmed_transaction_fee',
+    'projected_cash_for_pricing_basket',
+    'projected_cash_for_deliverable_basket',
+    'confirmed_cash_for_deliverable_basket', 'metal_entitlement',
+    'bid_spread', 'offer_spread', 'threshold', 'allocation_weight',
+    'deliverable_basket_qty', 'pricing_basket_qty', 'excluded_basket_qty',
+    'price(in_fund_base_currency)', 'factor', 'accrued_income',
+    'price_multiplier', 'contract_size', 'average_contract_open_price',
+    'spot_rate', 'nominal', 'rate', 'value', 'swap_notional',
+    'swap_spread', 'swap_mkt_value'])
+# Grains whose body rows are written comma delimited in .ff output
+COMMA_DELIMITED_GRAINS = ('fx', 'forwards')
+DUPLICATE_INDEX_SUFFIX = '.idx'
+# --writer sharded workers write part files to <outputfile>.parts/
+PART_DIRECTORY_SUFFIX = '.parts'
+MANIFEST_FILENAME = 'isharesfdfeqy_manifest.db'
+
+# Pipeline stages timed by FileMetrics. 'read' covers streaming the file and
+# splitting it into sections, which happen in one pass. In --batch mode,
+# 'isin_check' is the time spent waiting for the file's IsinVerifier result
+STAGES = ('read', 'date_validation', 'isin_check', 'transform',
+          'reconcile', 'duplicate_check', 'write', 'merge')
+METRICS_PREFIX = 'isharesfdfeqy'
+
+# Sections and Holdings: Securities columns read by reconcile_holdings().
+# Price comes first, then the quantities summed in the aggregate row
+RECONCILE_SECTIONS = ('Fund Level', 'Basket Level', 'Holdings: Securities')
+RECONCILE_COLUMNS = ('price(in_fund_base_currency)', 'deliverable_basket_qty',
+                     'pricing_basket_qty', 'excluded_basket_qty')
+RECONCILE_TOLERANCE = 0.01
+
+# Prefilters for format_date(). Every string datetime.strptime() accepts
+# for '%b %d %Y' also matches these, so anything that does not match can
+# be skipped without calling strptime
+DATE_PATTERN = re.compile(r'\S+\s+\d\d?\s+\d\d\d\d\Z')
+ROW_DATE_PATTERN = re.compile(r'\s\d\d\d\d(?:\||\Z)')
+# A line ending followed by an empty or whitespace-only line, which ends a
+# section, for iter_sections_mmap(). The leading literal lets the regex
+# engine skip ahead to line endings
+BLANK_LINE_PATTERN = re.compile(rb'\n[ \t\r\f\v]*(?:\n|\Z)')
 
 ORIGINAL_DIRECTORY = os.getcwd()
 HOME_DIRECTORY = str(Path.home())
@@ -45,17 +109,137 @@ TARGET_DIRECTORY = os.path.join(HOME_DIRECTORY,
                                 'fdf-proj',
                                 'csv_files',
                                 '20190124_files')
+ISIN_CACHE = os.path.join(HOME_DIRECTORY, '.cache', 'isharesfdfeqy_isin.db')
+ISIN_CACHE_TTL = 24 * 60 * 60
+# Funds per query, and queries in flight at once, for IsinVerifier
+ISIN_QUERY_CHUNK = 50
+ISIN_CONCURRENCY = 4
+# Column delimiter of the query command's output, None for any whitespace
+QUERY_DELIMITER = None
+# --watch polls its drop directory every WATCH_INTERVAL seconds, and serves
+# /status and /metrics on 127.0.0.1:STATUS_PORT
+WATCH_INTERVAL = 2.0
+STATUS_PORT = 8765
+ISIN_QUERIES = {
+    'name': (
+        'select markit_issue_name, isin'
+        ' from public.v_etp_mkt_ibp_classification'
+        ' where markit_issue_name in ({})'
+        ' and record_is_current = \'Y\''
+        ' and markit_issue_name not in'
+        ' (select markit_issue_name'
+        ' from public.v_etp_mkt_ibp_classification'
+        ' where record_is_current = \'Y\''
+        ' and markit_family=\'BlackRock\''
+        ' and markit_issue_name is not null'
+        ' and listing_region <> \'US\''
+        ' group by markit_issue_name'
+        ' having count(*) > 1)'),
+    'ticker': (
+        'select dixie_ticker, isin'
+        ' from public.v_etp_mkt_ibp_classification'
+        ' where dixie_ticker in ({})'
+        ' and record_is_current = \'Y\''
+        ' and markit_family=\'BlackRock\''
+        ' and dixie_ticker is not null'
+        ' and listing_region <> \'US\''
+        ' and dixie_ticker not in '
+        ' (select dixie_ticker'
+        ' from public.v_etp_mkt_ibp_classification'
+        ' where record_is_current = \'Y\''
+        ' and markit_family=\'BlackRock\''
+        ' and dixie_ticker is not null'
+        ' and listing_region <> \'US\''
+        ' group by dixie_ticker'
+        ' having count(*) > 1)')
+    }
 
 
-def parse_args():
-    """Parses user provided arguments with argparse's ArgumentParser."""
+def parse_args(argv=None):
+    """Parses user provided arguments with argparse's ArgumentParser.
+    `argv` defaults to sys.argv[1:]."""
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--inputfile', required=True,
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-i', '--inputfile',
                         help='Input file to process')
+    inputs.add_argument('-b', '--batch',
+                        help='Directory or glob pattern of input files to'
+                        ' process in parallel')
+    inputs.add_argument('--watch', nargs='?', const=TARGET_DIRECTORY,
+                        metavar='DIRECTORY',
+                        help='Run as a service, parsing FDF files as they'
+                        ' land in DIRECTORY (default: {})'
+                        .format(TARGET_DIRECTORY))
     parser.add_argument('-o', '--outputfile', required=True,
-                        help='Output file to write to')
+                        help='Output file to write to. When more than one'
+                        ' grain is requested, a directory to write every'
+                        ' isharesfdfeqy_<grain>.ff file to')
     parser.add_argument('-g', '--grain', required=True,
-                        help='Dictates the grain of data we are seeking')
+                        help='Dictates the grain of data we are seeking.'
+                        ' Accepts a single grain, a comma separated list of'
+                        ' grains, or "all"')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=os.cpu_count(),
+                        help='Number of worker processes for --batch mode')
+    parser.add_argument('--writer', default='single',
+                        choices=['single', 'sharded'],
+                        help='single: the main process writes every file to'
+                        ' the output (default). sharded: --batch workers'
+                        ' write a part file per input file and grain, which'
+                        ' are merged into the output. Requires'
+                        ' --output-format ff')
+    parser.add_argument('--output-format', default='ff',
+                        choices=list(OUTPUT_FORMATS),
+                        help='ff: pipe delimited flatfiles (default).'
+                        ' parquet/arrow: typed columnar files, one per input'
+                        ' file, under <outputfile>/isharesfdfeqy_<grain>/'
+                        'f_position_date=<date>/. Requires pyarrow')
+    parser.add_argument('--manifest',
+                        help='Processing manifest used to skip input files'
+                        ' that were already written. Defaults to {} next to'
+                        ' the output'.format(MANIFEST_FILENAME))
+    parser.add_argument('-nm', '--nomanifest', action='store_true',
+                        help='Process every input file, ignoring and not'
+                        ' updating the manifest')
+    parser.add_argument('--reader', default='stream',
+                        choices=['stream', 'mmap'],
+                        help='stream: read input files line by line'
+                        ' (default). mmap: memory-map input files and decode'
+                        ' only the sections needed for the grain(s)')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='Check holdings quantities against the'
+                        ' aggregate row and the pricing basket against NAV'
+                        ' * PNU, and warn about mismatches. Requires numpy')
+    parser.add_argument('--reconcile-tolerance', type=float,
+                        default=RECONCILE_TOLERANCE,
+                        help='Relative tolerance of the --reconcile pricing'
+                        ' basket check')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Report import and setup time to stderr')
+    parser.add_argument('--query-command', default='query',
+                        help='Executable used for ISIN verification queries')
+    parser.add_argument('--query-delimiter', default=QUERY_DELIMITER,
+                        help='Column delimiter of the query output'
+                        ' (default: whitespace)')
+    parser.add_argument('--isin-cache', default=ISIN_CACHE,
+                        help='SQLite cache of verified ISINs')
+    parser.add_argument('--isin-ttl', type=int, default=ISIN_CACHE_TTL,
+                        help='Seconds a cached ISIN stays valid')
+    parser.add_argument('--isin-concurrency', type=int,
+                        default=ISIN_CONCURRENCY,
+                        help='ISIN queries run at once in --batch mode')
+    parser.add_argument('--poll-interval', type=float,
+                        default=WATCH_INTERVAL,
+                        help='Seconds between scans of the --watch directory')
+    parser.add_argument('--status-port', type=int, default=STATUS_PORT,
+                        help='Local port serving /status and /metrics in'
+                        ' --watch mode, 0 to disable')
+    parser.add_argument('--metrics',
+                        help='Append a JSON metrics record per input file,'
+                        ' and one for the run, to this file')
+    parser.add_argument('--prometheus',
+                        help='Write run metrics to this Prometheus textfile'
+                        ' collector file')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='increase output verbosity')
     parser.add_argument('-d', '--debug', action='store_true',
@@ -67,7 +251,7 @@ def parse_args():
                         help='NOT IMPLEMENTED. Do not ouput header columns')
     parser.add_argument('-nc', '--nocleanup',
                         help='NOT IMPLEMENTED. Leave a trail for inspection')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
@@ -121,6 +305,203 @@ def parse_data(string_list, start, end):
     return string_list_parsed
 
 
+class SectionIndex:
+    """Index of the lines of an FDF file, for repeated parse_data() lookups
+    without re-scanning the file from index 0.
+
+    Built in a single pass over `string_list`. Records the first index of
+    every distinct (stripped) line and of the first empty line at or after
+    it, so parse_data(start, '') is an O(1) lookup that returns exactly what
+    the module level parse_data() does. Any other `end` is searched for from
+    `start`'s index on.
+
+    Example:
+        index = SectionIndex(['A Lvl', 'A1', 'A2', '', 'B Lvl', 'B1', ''])
+        index.parse_data('B Lvl', '')
+        >>> ['B1']
+    """
+
+    def __init__(self, string_list):
+        self.string_list = string_list
+        self.starts = {}
+        self.blank_ends = {}
+        waiting = []
+        for index, string in enumerate(string_list):
+            stripped = string.strip()
+            if stripped not in self.starts:
+                self.starts[stripped] = index
+                waiting.append(stripped)
+            if stripped == '':
+                for name in waiting:
+                    self.blank_ends[name] = index
+                waiting = []
+
+    def parse_data(self, start, end):
+        """Extracts the lines between `start` and `end`. See parse_data()."""
+        start_index = self.starts.get(start)
+        if start_index is None:
+            bailout('search string {} not found'.format(start))
+        if end == '':
+            end_index = self.blank_ends.get(start)
+        else:
+            end_index = next((index for index in range(start_index,
+                                                       len(self.string_list))
+                              if self.string_list[index].strip() == end),
+                             None)
+        if end_index is None:
+            bailout('ending string {} not found'.format(end))
+        return self.string_list[start_index + 1:end_index]
+
+
+def iter_sections(infile, names=None):
+    """Lazily yields sections from a file handle, one section at a time.
+
+    With `names`, a section starts at the first line equal to its name,
+    wherever that line is, as in parse_data(). Without, a section starts at
+    every non-empty line that opens the file or follows an empty line. A
+    section ends at the next empty line, or at the end of the file if its
+    last line ends in a line break, which parse_data() sees as a final
+    empty string. Only the rows of the current section(s) are held in
+    memory, and rows of sections not in `names` are never stored, so memory
+    use is bounded by the largest requested section rather than by the
+    whole file.
+
+    Args:
+        `infile`: An iterable of lines, e.g. a file opened in text mode
+        `names`: An optional collection of section names to yield. All
+        sections are yielded if not provided
+
+    Yields:
+        `(section_name, rows)`: A section name and a list of strings that
+        fall between the section name and the next empty line
+
+    Example:
+        list(iter_sections(io.StringIO('A Lvl\nA1\n\nB Lvl\nB1\n')))
+        >>> [('A Lvl', ['A1']), ('B Lvl', ['B1'])]
+    """
+    seen = set()
+    # Sections being read, in start order. A section header without an
+    # empty line before it is part of the section above it as well
+    current = {}
+    previous = ''
+    line = ''
+    for line in infile:
+        string = line.rstrip('\n')
+        stripped = string.strip()
+        if stripped == '':
+            yield from current.items()
+            current = {}
+        else:
+            for rows in current.values():
+                rows.append(string)
+            if stripped not in seen and (previous == '' if names is None
+                                         else stripped in names):
+                seen.add(stripped)
+                current[stripped] = []
+        previous = stripped
+
+    if line.endswith('\n'):
+        yield from current.items()
+    elif current:
+        bailout('ending string for {} not found'.format(next(iter(current))))
+
+
+def iter_sections_mmap(inputfile, names=None):
+    """Lazily yields sections of `inputfile` like iter_sections(), reading
+    the file through mmap.
+
+    Section headers and the blank lines that end sections are located with
+    byte-level searches, and only the header lines and the rows of sections
+    in `names` are decoded. A UTF-8 BOM is skipped, as with 'utf-8-sig', and
+    '\\r\\n' line endings are read as '\\n'. Lines ending in a lone '\\r' are
+    not split.
+
+    Args:
+        `inputfile`: Path of the file to read
+        `names`: An optional collection of section names to yield. All
+        sections are yielded if not provided
+    """
+    with open(inputfile, mode='rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if names is not None:
+                headers = []
+                for name in names:
+                    match = section_pattern(name).search(data)
+                    if match is not None:
+                        headers.append((match.end(), name))
+            else:
+                headers = iter_headers(data)
+            for line_end, name in sorted(headers):
+                end = find_blank_line(data, line_end)
+                if end is None:
+                    bailout('ending string for {} not found'.format(name))
+                text = data[line_end + 1:end].decode('utf-8')
+                if '\r' in text:
+                    text = text.replace('\r\n', '\n')
+                rows = text.split('\n')
+                # Drop the '' after the last row's line ending
+                rows.pop()
+                yield name, rows
+
+
+@lru_cache(maxsize=64)
+def section_pattern(name):
+    """Returns a regex matching a line of bytes that strips to `name`, for
+    iter_sections_mmap(). A UTF-8 BOM is allowed before the first line."""
+    return re.compile(rb'(?m)(?:^|\A\xef\xbb\xbf)[ \t\f\v]*'
+                      + re.escape(name.encode('utf-8'))
+                      + rb'[ \t\r\f\v]*$')
+
+
+def iter_headers(data):
+    """Yields (offset of the line ending, name) for every section header of
+    `data`, a line that opens the file or follows an empty line, skipping
+    over section rows with find_blank_line()."""
+    seen = set()
+    size = len(data)
+    position = 0
+    if data[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8:
+        position = len(codecs.BOM_UTF8)
+    while position < size:
+        line_end = data.find(b'\n', position)
+        if line_end == -1:
+            line_end = size
+        name = data[position:line_end].decode('utf-8').strip()
+        if name == '':
+            position = line_end + 1
+            continue
+        if name not in seen:
+            seen.add(name)
+            yield line_end, name
+        position = find_blank_line(data, line_end)
+        if position is None:
+            break
+
+
+def find_blank_line(data, position):
+    """Returns the offset of the first empty or whitespace-only line after
+    the line ending at or after `position` in `data`, or None if there is
+    none. A final line ending counts as one, like the empty string
+    parse_data() sees after it."""
+    match = BLANK_LINE_PATTERN.search(data, position)
+    if match is None:
+        return None
+    return match.start() + 1
+
+
+def read_sections(inputfile, names=None, reader='stream'):
+    """Yields the sections of `inputfile` with iter_sections() on the file
+    opened in text mode, or with iter_sections_mmap() if `reader` is
+    'mmap'."""
+    if reader == 'mmap':
+        yield from iter_sections_mmap(inputfile, names)
+        return
+    with open(inputfile, mode='r', encoding='utf-8-sig') as infile:
+        yield from iter_sections(infile, names)
+
+
 def transpose(string_list):
     """Transposes a list of comma delimited strings.
 
@@ -162,6 +543,9 @@ def transpose(string_list):
 def merge_holdings(data):
     """Merges a list of two lists (Securities and Synthetics data).
 
+    Rows are split on commas and merged over the union of the two headers
+    with merge_sections(), as extract_grain() does.
+
     Args:
         `data`: A list of lists of comma-delimited strings
 
@@ -176,33 +560,17 @@ def merge_holdings(data):
     sec_data = [row.split(',') for row in data[0]]
     syn_data = [row.split(',') for row in data[1]]
 
-    # Headers: Strip whitespace, lower, and replace spaces with underscores
-    sec_h_temp = list(map(str.lower, [val.strip() for val in sec_data[0]]))
-    syn_h_temp = list(map(str.lower, [val.strip() for val in syn_data[0]]))
-    sec_h = [val.replace(' ', '_') for val in sec_h_temp]
-    syn_h = [val.replace(' ', '_') for val in syn_h_temp]
-
-    # Data Prep: Separate body (b) from header (h) to prep for dataframe
-    # creation
     # (!!!) Last row of Holdings: Securities section contains aggregate
     # information for Deliverable Basket Qty and Pricing Basket Qty,
     # this is removed to prevent duplication
-    sec_b = sec_data[1:len(sec_data) - 1]
-    syn_b = syn_data[1:]
-
-    # Dataframes: Create sec_df and syn_df
-    sec_df = pd.DataFrame(sec_b, columns=sec_h)
-    syn_df = pd.DataFrame(syn_b, columns=syn_h)
-
-    # Dataframes: Merge, replace NaN's with '', convert values to a list
-    merged_holdings_df = pd.concat([sec_df, syn_df]).fillna('')
-    result = merged_holdings_df.values.tolist()
-
-    # Combine header and body
-    result.insert(0, list(merged_holdings_df))
-
-    # Output
-    result_writeable = ['|'.join(row) for row in result]
+    columns, body = merge_sections(
+        [(Columns([normalize_column(val) for val in sec_data[0]]),
+          sec_data[1:len(sec_data) - 1]),
+         (Columns([normalize_column(val) for val in syn_data[0]]),
+          syn_data[1:])])
+
+    result_writeable = ['|'.join(columns.names)]
+    result_writeable.extend(['|'.join(values) for values in body])
     return result_writeable
 
 
@@ -213,10 +581,25 @@ def bailout(message):
     sys.exit(1)
 
 
+@lru_cache(maxsize=4096)
+def convert_date(target):
+    """Converts a MMM DD YYYY string to YYYY-MM-DD, or returns None if
+    `target` is not a date. Memoized, as FDF files repeat the same few
+    dates on every row."""
+    try:
+        return datetime.strptime(target, '%b %d %Y').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+
 def format_date(string_list):
     """Iterates through a list of pipe-delimited strings and converts all
     MMM DD YYY pattern dates to the YYYY-MM-DD pattern.
 
+    Rows and values that cannot hold a date are rejected with precompiled
+    regex prefilters, and the remaining candidates are converted through
+    the memoized convert_date().
+
     Args:
         `string_list`: A list of pipe delimited strings
 
@@ -234,14 +617,19 @@ def format_date(string_list):
     non_date_values = 0
     date_formatted_string_list = []
     for string in string_list:
+        if not ROW_DATE_PATTERN.search(string):
+            non_date_values += string.count('|') + 1
+            date_formatted_string_list.append(string)
+            continue
         targets = string.split('|')
         for i, target in enumerate(targets):
-            try:
-                date = datetime.strptime(target, '%b %d %Y')
-                targets[i] = date.strftime('%Y-%m-%d')
-                date_values += 1
-            except ValueError:
+            date = (convert_date(target) if DATE_PATTERN.match(target)
+                    else None)
+            if date is None:
                 non_date_values += 1
+            else:
+                targets[i] = date
+                date_values += 1
         date_formatted_string_list.append('|'.join(targets))
 
     logging.debug('format_date() processed {} date values and {} non'
@@ -304,17 +692,15 @@ def confirm_grain_is_valid(grain):
                 .format(grain, list(GRAINS.keys())))
 
 
-def confirm_valid_date(file_contents):
-    """Confirms that dates in the Fund Level section of the input file are
-    identical and returns a formatted date.
-    """
+def confirm_valid_fund_dates(fund_level_rows):
+    """Confirms that dates in already parsed Fund Level rows are identical
+    and returns a formatted date."""
     logging.info('working on validating dates in Fund Level section of FDF ...'
                  ' PROCESSING')
-    write_data = parse_data(file_contents, 'Fund Level', '')
     date_set = set()
-    for row in write_data:
-        if row.count(',') == 2 and row.split(',')[2] != '':
-            date_set.add(row.split(',')[2])
+    for fields in tokenize(fund_level_rows):
+        if len(fields) == 3 and fields[2] != '':
+            date_set.add(fields[2])
     if len(date_set) == 1:
         date = datetime.strptime(next(iter(date_set)),
                                  '%b %d %Y').strftime('%Y-%m-%d')
@@ -325,33 +711,188 @@ def confirm_valid_date(file_contents):
         bailout('dates in Fund Level section do not match, exiting. ')
 
 
-def confirm_no_duplicates(data_list, outfile):
+def confirm_valid_date(file_contents):
+    """Confirms that dates in the Fund Level section of the input file are
+    identical and returns a formatted date.
+
+    `file_contents` is a list of strings, or a SectionIndex over one. See
+    confirm_valid_fund_dates().
+    """
+    if isinstance(file_contents, SectionIndex):
+        fund_level_rows = file_contents.parse_data('Fund Level', '')
+    else:
+        fund_level_rows = parse_data(file_contents, 'Fund Level', '')
+    return confirm_valid_fund_dates(fund_level_rows)
+
+
+class DuplicateIndex:
+    """Persistent sidecar index of row hashes for an output file.
+
+    Stored as a SQLite database at `<outputfile>.idx`. Each row is keyed by
+    a hash of everything after the source_category, source_name and
+    f_position_date columns, which is what confirm_no_duplicates() compares.
+    The index is updated incrementally on every write, so duplicate checks
+    cost O(new rows) instead of re-reading the whole output file. The size,
+    mtime and inode of the output file are recorded after each update, and
+    compared when the index is opened and before every check; if they do
+    not match, e.g. the file was edited by hand, predates the index, or was
+    rotated while a --watch service held the index open, the index is
+    rebuilt from the file once. If the file no longer ends with a newline,
+    an append was killed part way: it is truncated back to the size last
+    recorded, or to its last complete row if that size does not apply.
+    """
+
+    def __init__(self, outputfile):
+        self.outputfile = outputfile
+        self.path = outputfile + DUPLICATE_INDEX_SUFFIX
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('create table if not exists row_hashes'
+                                ' (hash blob primary key) without rowid')
+        self.connection.execute('create table if not exists meta'
+                                ' (key text primary key, value integer)')
+        self.refresh()
+
+    @staticmethod
+    def row_hash(string):
+        """Returns the index key for a row, without informational columns."""
+        return hashlib.blake2b(string.encode('utf-8'), digest_size=16).digest()
+
+    def _file_stat(self):
+        if not os.path.isfile(self.outputfile):
+            return None
+        stat = os.stat(self.outputfile)
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def _stored_stat(self):
+        meta = dict(self.connection.execute('select key, value from meta'))
+        if 'size' not in meta:
+            return None
+        return meta['size'], meta['mtime_ns'], meta.get('inode')
+
+    def _store_stat(self):
+        stat = self._file_stat()
+        if stat is None:
+            self.connection.execute('delete from meta')
+        else:
+            self.connection.executemany(
+                'insert or replace into meta values (?, ?)',
+                [('size', stat[0]), ('mtime_ns', stat[1]),
+                 ('inode', stat[2])])
+        self.connection.commit()
+
+    def refresh(self):
+        """Rebuilds the index if the output file changed since it was last
+        indexed. A torn last row, left by a write that was killed part way,
+        is truncated away first."""
+        stored, current = self._stored_stat(), self._file_stat()
+        if stored == current:
+            return
+        if current is not None and not ends_with_newline(self.outputfile):
+            if (stored is not None and stored[2] == current[2]
+                    and stored[0] < current[0]):
+                # Appended to since the last indexed write: the index still
+                # matches the file up to the size it recorded
+                self.truncate(stored[0])
+                self._store_stat()
+                return
+            self.truncate(last_line_end(self.outputfile))
+        self.rebuild()
+
+    def truncate(self, size):
+        """Truncates the output file to `size` bytes."""
+        logging.warning('{} ends with a partial row, truncating it from {}'
+                        ' to {} bytes'
+                        .format(self.outputfile,
+                                os.path.getsize(self.outputfile), size))
+        os.truncate(self.outputfile, size)
+
+    def rebuild(self):
+        """Rebuilds the index from the rows currently in the output file."""
+        logging.info('rebuilding duplicate index {}'.format(self.path))
+        self.connection.execute('delete from row_hashes')
+        if os.path.isfile(self.outputfile):
+            with open(self.outputfile, mode='r') as outfile:
+                next(outfile, None)
+                self.connection.executemany(
+                    'insert or ignore into row_hashes values (?)',
+                    ((self.row_hash('|'.join(line.rstrip('\n')
+                                             .split('|')[3:])),)
+                     for line in outfile))
+        self._store_stat()
+
+    def overlap(self, data_list):
+        """Returns the set of strings in `data_list` already indexed."""
+        self.refresh()
+        hashes = {self.row_hash(string): string for string in data_list}
+        keys = list(hashes)
+        found = set()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            found.update(row[0] for row in self.connection.execute(
+                'select hash from row_hashes where hash in ({})'
+                .format(','.join('?' * len(chunk))), chunk))
+        return {hashes[key] for key in found}
+
+    def add(self, data_list, reset=False):
+        """Indexes `data_list` after it has been written to the output file.
+        With `reset`, previously indexed rows are dropped first."""
+        if reset:
+            self.connection.execute('delete from row_hashes')
+        self.connection.executemany(
+            'insert or ignore into row_hashes values (?)',
+            ((self.row_hash(string),) for string in data_list))
+        self._store_stat()
+
+    def close(self):
+        self.connection.close()
+
+
+def ends_with_newline(path):
+    """Returns whether the file at `path` is empty or ends with a newline."""
+    with open(path, mode='rb') as infile:
+        if infile.seek(0, os.SEEK_END) == 0:
+            return True
+        infile.seek(-1, os.SEEK_END)
+        return infile.read(1) == b'\n'
+
+
+def last_line_end(path, chunk_size=1 << 16):
+    """Returns the offset just past the last newline in the file at `path`,
+    or 0 if it has none."""
+    with open(path, mode='rb') as infile:
+        end = infile.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - chunk_size)
+            infile.seek(start)
+            position = infile.read(end - start).rfind(b'\n')
+            if position != -1:
+                return start + position + 1
+            end = start
+    return 0
+
+
+def confirm_no_duplicates(data_list, outfile, index=None):
     """Confirms that rows to append to an outfile do not
-    include duplicates via set intersection.
+    include duplicates, via lookups in the outfile's DuplicateIndex.
 
     Args:
         `data_list`: A list of strings to be appended to outfile
         `outfile`: A string for the name of file to check
+        `index`: An optional open DuplicateIndex for outfile
 
     Returns:
         `boolean`: True if no duplicates, bailout() if there
         are duplicates
     """
-    # Remove existing source_category, source_name, f_position_date columns
-    existing = []
-    with open(outfile, 'r') as outfile:
-        existing_raw = outfile.readlines()
-    for string_raw in existing_raw:
-        string = '|'.join(string_raw.split('|')[3:])
-        existing.append(string)
-
-    # Remove header and add newline char to data_list for comparison
-    data_list = [string + '\n' for string in data_list][1:]
-
-    # Instantiate sets and intersection (items that are in both sets)
-    existing_set = set(existing)
-    data_list_set = set(data_list)
-    intersection = existing_set & data_list_set
+    opened = index is None
+    if opened:
+        index = DuplicateIndex(outfile)
+    try:
+        # Remove header before comparison
+        intersection = index.overlap(data_list[1:])
+    finally:
+        if opened:
+            index.close()
 
     if not intersection:
         logging.info('no overlap with existing rows, proceeding')
@@ -359,166 +900,754 @@ def confirm_no_duplicates(data_list, outfile):
     else:
         bailout('{} row(s) to append to {} overlap with existing rows,'
                 ' culprit(s): {}'
-                .format(len(intersection), outfile.name, intersection))
+                .format(len(intersection), outfile, intersection))
 
 
-def confirm_valid_isin(args_inputfile):
-    """Confirms that Fund Name in file maps to an ISIN"""
-    logging.info('executing query/SQL verification ...')
-    with open(args_inputfile) as inputfile:
-        rows = inputfile.readlines()
-    for row in rows:
-        cur = row.split(',')
-        if cur[0] == 'Fund Name':
-            query_1 = (
-                'select isin'
-                ' from public.v_etp_mkt_ibp_classification'
-                ' where markit_issue_name= \'{}\''
-                ' and record_is_current = \'Y\''
-                ' and markit_issue_name not in'
-                ' (select markit_issue_name'
-                ' from public.v_etp_mkt_ibp_classification'
-                ' where record_is_current = \'Y\''
-                ' and markit_family=\'BlackRock\''
-                ' and markit_issue_name is not null'
-                ' and listing_region <> \'US\''
-                ' group by markit_issue_name'
-                ' having count(*) > 1)').format(cur[1].rstrip())
-            res_object_1 = run(['query', 'aeon', query_1, 'kettle', 'blk-w'])
-            type(run(['query', 'aeon', query_1, 'kettle', 'blk-w']))
-            run(['query', 'aeon', query_1, 'kettle', 'blk-w'])
-            run(['query', 'aeon', query_1, 'kettle', 'blk-w'])
-            logging.info('command executed: {}'
-                         .format(' '.join(res_object_1.args)))
-            logging.info('command stdout: {}'.format(res_object_1.stdout))
-            print('res_object_1:', res_object_1)
-            if res_object_1.returncode == 1:
-                logging.info('ISIN found in'
-                             ' public.v_etp_mkt_ibp_classification via'
-                             ' Fund Name')
-                return 0
-
-        elif cur[0] == 'Fund Ticker':
-            query_2 = (
-                'select isin'
-                ' from public.v_etp_mkt_ibp_classification'
-                ' where dixie_ticker= \'{}\''
-                ' and record_is_current = \'Y\''
-                ' and markit_family=\'BlackRock\''
-                ' and dixie_ticker is not null'
-                ' and listing_region <> \'US\''
-                ' and dixie_ticker not in '
-                ' (select dixie_ticker'
-                ' from public.v_etp_mkt_ibp_classification'
-                ' where record_is_current = \'Y\''
-                ' and markit_family=\'BlackRock\''
-                ' and dixie_ticker is not null'
-                ' and listing_region <> \'US\''
-                ' group by dixie_ticker'
-                ' having count(*) > 1)').format(cur[1].rstrip())
-            res_object_2 = run(['query', 'aeon', query_2, 'kettle', 'blk-w'])
-            logging.info('command executed: {}'
-                         .format(' '.join(res_object_2.args)))
-            logging.info('command stdout: {}'.format(res_object_2.stdout))
-            print('res_object_2:', res_object_2)
-            if res_object_2.returncode == 0:
-                logging.info('ISIN found in'
-                             ' public.v_etp_mkt_ibp_classification from'
-                             ' Fund Ticker')
-                return 0
+class AeonQueryBackend:
+    """Runs SQL with the external `query aeon <sql> kettle blk-w` command.
+
+    Called with a SQL string, returns a list of rows parsed from the
+    command's stdout by parse_query_rows(). Any callable with the same
+    signature can be passed to IsinLookup in its place.
+
+    Args:
+        `command`: The query executable
+        `delimiter`: Column delimiter of its output, None for whitespace
+    """
+
+    def __init__(self, command='query', delimiter=QUERY_DELIMITER):
+        self.command = command
+        self.delimiter = delimiter
+
+    def __call__(self, sql):
+        res_object = run([self.command, 'aeon', sql, 'kettle', 'blk-w'],
+                         stdout=PIPE, universal_newlines=True)
+        logging.info('command executed: {}'.format(' '.join(res_object.args)))
+        logging.debug('command stdout: {}'.format(res_object.stdout))
+        if res_object.returncode != 0:
+            logging.warning('command returned {}'
+                            .format(res_object.returncode))
+        return parse_query_rows(res_object.stdout, self.delimiter)
+
+    async def query_async(self, sql):
+        """Coroutine version of calling the backend. The command runs as an
+        asyncio subprocess, so other queries proceed while it waits."""
+        import asyncio
+        args = [self.command, 'aeon', sql, 'kettle', 'blk-w']
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE)
+        stdout, _ = await process.communicate()
+        stdout = stdout.decode()
+        logging.info('command executed: {}'.format(' '.join(args)))
+        logging.debug('command stdout: {}'.format(stdout))
+        if process.returncode != 0:
+            logging.warning('command returned {}'.format(process.returncode))
+        return parse_query_rows(stdout, self.delimiter)
+
+
+def parse_query_rows(stdout, delimiter=QUERY_DELIMITER):
+    """Splits query output into (key, ISIN) rows of stripped values.
+
+    The first line is the column header and is skipped, as the Perl
+    parsers do with `tail -n +2`. Each following line is split on the last
+    `delimiter` (None for any whitespace), since a Fund Name may contain
+    the delimiter but an ISIN never does. Bails out if there are lines but
+    none of them splits, rather than reporting every fund as unknown.
+
+    Example:
+        parse_query_rows('markit_issue_name isin\nFund A  IE00B6R51Z18\n')
+        >>> [['Fund A', 'IE00B6R51Z18']]
+    """
+    lines = [line for line in stdout.splitlines()[1:] if line.strip()]
+    rows = [[value.strip() for value in line.rsplit(delimiter, 1)]
+            for line in lines]
+    rows = [row for row in rows if len(row) == 2 and all(row)]
+    if lines and not rows:
+        bailout('cannot parse query output with delimiter {!r}: {!r}'
+                .format(delimiter, lines[0]))
+    return rows
+
+
+class IsinLookup:
+    """Resolves Fund Names and Fund Tickers to ISINs in batches.
+
+    All uncached names are resolved with a single query, then the tickers
+    of funds whose name did not resolve with a second one. Hits are stored
+    in a SQLite cache keyed by (kind, key) and reused for `ttl` seconds, so
+    repeat runs for the same fund make no query calls. Funds that resolve
+    by neither name nor ticker are not cached.
+
+    Args:
+        `backend`: A callable taking SQL and returning rows of
+        (key, isin). Defaults to AeonQueryBackend()
+        `cache_path`: Path of the SQLite cache, or ':memory:'
+        `ttl`: Seconds a cached ISIN stays valid
+    """
 
+    def __init__(self, backend=None, cache_path=ISIN_CACHE,
+                 ttl=ISIN_CACHE_TTL):
+        self.backend = backend if backend is not None else AeonQueryBackend()
+        self.ttl = ttl
+        if cache_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)),
+                        exist_ok=True)
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute('create table if not exists isin_cache'
+                                ' (kind text, key text, isin text,'
+                                ' fetched real, primary key (kind, key))')
+
+    def cached(self, kind, keys):
+        """Returns a dict of key to ISIN for unexpired cache entries."""
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            found.update(self.connection.execute(
+                'select key, isin from isin_cache'
+                ' where kind = ? and fetched >= ? and key in ({})'
+                .format(','.join('?' * len(chunk))),
+                [kind, time() - self.ttl] + chunk))
+        return found
+
+    def store(self, kind, found):
+        """Caches a dict of key to ISIN."""
+        now = time()
+        self.connection.executemany(
+            'insert or replace into isin_cache values (?, ?, ?, ?)',
+            [(kind, key, isin, now) for key, isin in found.items()])
+        self.connection.commit()
+
+    @staticmethod
+    def sql(kind, keys):
+        """Returns the ISIN_QUERIES SQL resolving `keys`."""
+        quoted = ','.join("'{}'".format(key.replace("'", "''"))
+                          for key in keys)
+        return ISIN_QUERIES[kind].format(quoted)
+
+    def found(self, kind, keys, rows):
+        """Caches and returns the ISINs for `keys` in query result rows."""
+        found = {row[0]: row[1] for row in rows
+                 if len(row) >= 2 and row[0] in keys and row[1]}
+        self.store(kind, found)
+        return found
+
+    def query(self, kind, keys):
+        """Resolves `keys` with a single backend query."""
+        return self.found(kind, keys, self.backend(self.sql(kind, keys)))
+
+    async def query_async(self, kind, keys):
+        """Coroutine version of query(). A backend without a query_async()
+        coroutine is called in a thread instead."""
+        import asyncio
+        sql = self.sql(kind, keys)
+        if hasattr(self.backend, 'query_async'):
+            rows = await self.backend.query_async(sql)
+        else:
+            rows = await asyncio.get_running_loop().run_in_executor(
+                None, self.backend, sql)
+        return self.found(kind, keys, rows)
+
+    def lookup(self, kind, keys):
+        """Resolves `keys` from the cache, querying only for misses."""
+        keys = set(key for key in keys if key)
+        found = self.cached(kind, keys)
+        missing = keys - found.keys()
+        if missing:
+            logging.info('querying {} uncached fund {}(s)'
+                         .format(len(missing), kind))
+            found.update(self.query(kind, missing))
+        return found
+
+    async def lookup_async(self, kind, keys):
+        """Coroutine version of lookup()."""
+        keys = set(key for key in keys if key)
+        found = self.cached(kind, keys)
+        missing = keys - found.keys()
+        if missing:
+            logging.info('querying {} uncached fund {}(s)'
+                         .format(len(missing), kind))
+            found.update(await self.query_async(kind, missing))
+        return found
+
+    def resolve(self, funds):
+        """Resolves a list of (fund_name, fund_ticker) tuples.
+
+        Returns:
+            `isins`: A dict of (fund_name, fund_ticker) to an ISIN, or None
+            if neither the name nor the ticker resolved
+        """
+        funds = list(funds)
+        by_name = self.lookup('name', [name for name, _ in funds])
+        unresolved = [fund for fund in funds if not by_name.get(fund[0])]
+        by_ticker = {}
+        if unresolved:
+            by_ticker = self.lookup('ticker',
+                                    [ticker for _, ticker in unresolved])
+        return self.resolved(funds, by_name, unresolved, by_ticker)
+
+    async def resolve_async(self, funds):
+        """Coroutine version of resolve()."""
+        funds = list(funds)
+        by_name = await self.lookup_async('name', [name for name, _ in funds])
+        unresolved = [fund for fund in funds if not by_name.get(fund[0])]
+        by_ticker = {}
+        if unresolved:
+            by_ticker = await self.lookup_async(
+                'ticker', [ticker for _, ticker in unresolved])
+        return self.resolved(funds, by_name, unresolved, by_ticker)
+
+    def resolved(self, funds, by_name, unresolved, by_ticker):
+        """Combines name and ticker lookups into the result of
+        resolve()."""
+        # Remember names that only resolve via their ticker, so the name is
+        # not queried again on every run
+        self.store('name', {name: '' for name, ticker in unresolved
+                            if name and by_ticker.get(ticker)
+                            and name not in by_name})
+        return {(name, ticker): by_name.get(name) or by_ticker.get(ticker)
+                for name, ticker in funds}
+
+    def close(self):
+        self.connection.close()
+
+
+def read_fund_identity(inputfile):
+    """Returns the (Fund Name, Fund Ticker) of an FDF file, reading only as
+    far as the Fund Level rows that hold them."""
+    fund_name = fund_ticker = None
+    with open(inputfile, mode='r', encoding='utf-8-sig') as infile:
+        for row in infile:
+            cur = tokenize([row])[0]
+            if cur[0] == 'Fund Name':
+                fund_name = cur[1].rstrip()
+            elif cur[0] == 'Fund Ticker':
+                fund_ticker = cur[1].rstrip()
+            if fund_name is not None and fund_ticker is not None:
+                break
+    return fund_name, fund_ticker
+
+
+def confirm_valid_isins(inputfiles, lookup):
+    """Verifies the Fund Name or Fund Ticker of every input file maps to an
+    ISIN, in one batch.
+
+    Returns:
+        `verified`, `failed`: Lists of input files
+    """
+    logging.info('executing query/SQL verification for {} files ...'
+                 .format(len(inputfiles)))
+    identities = {inputfile: read_fund_identity(inputfile)
+                  for inputfile in inputfiles}
+    isins = lookup.resolve(set(identities.values()))
+    verified, failed = [], []
+    for inputfile, identity in identities.items():
+        if isins[identity] is not None:
+            verified.append(inputfile)
+        else:
+            logging.error('ISIN not found in'
+                          ' public.v_etp_mkt_ibp_classification via Fund'
+                          ' Name or Ticker for {}'.format(identity))
+            failed.append(inputfile)
+    return verified, failed
+
+
+def confirm_valid_isin(args_inputfile, lookup):
+    """Confirms that Fund Name or Fund Ticker in file maps to an ISIN"""
+    verified, _ = confirm_valid_isins([args_inputfile], lookup)
+    if verified:
+        logging.info('ISIN found in public.v_etp_mkt_ibp_classification')
+        return 0
     bailout('ISIN not found in public.v_etp_mkt_ibp_classification'
             ' via Fund Name or Ticker')
 
 
-def main():
-    """Handles the actual logic of the script."""
-    args = parse_args()
-    if args.debug:
-        logging.basicConfig(level=logging.DEBUG,
-                            format=LOG_FORMAT, datefmt=LOG_DATEFMT)
-    elif args.verbose:
-        logging.basicConfig(level=logging.INFO,
-                            format=LOG_FORMAT, datefmt=LOG_DATEFMT)
+class IsinVerifier:
+    """Verifies the ISINs of a batch on a background thread, so the external
+    queries overlap with parsing.
+
+    Funds are resolved in chunks of `chunk_size` by an asyncio event loop
+    on the thread, with at most `concurrency` chunks querying at once.
+    verified() blocks until the given input file's fund is resolved.
+
+    Args:
+        `inputfiles`: A list of input files to verify
+        `make_lookup`: A callable returning the IsinLookup to use. It is
+        called on the background thread, which then owns its connection
+        `concurrency`: Chunks resolved at once
+        `chunk_size`: Funds per chunk
+    """
+
+    def __init__(self, inputfiles, make_lookup, concurrency=ISIN_CONCURRENCY,
+                 chunk_size=ISIN_QUERY_CHUNK):
+        import threading
+        from concurrent.futures import Future
+        self.make_lookup = make_lookup
+        self.concurrency = max(1, concurrency)
+        self.chunk_size = max(1, chunk_size)
+        self.futures = {inputfile: Future() for inputfile in inputfiles}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        import asyncio
+        try:
+            lookup = self.make_lookup()
+            try:
+                asyncio.run(self.verify_all(lookup))
+            finally:
+                lookup.close()
+        except BaseException as error:
+            # Surface failures (e.g. a missing query command) to the
+            # threads waiting in verified()
+            for future in self.futures.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def verify_all(self, lookup):
+        import asyncio
+        logging.info('executing query/SQL verification for {} files ...'
+                     .format(len(self.futures)))
+        files_by_fund = {}
+        for inputfile in self.futures:
+            files_by_fund.setdefault(read_fund_identity(inputfile),
+                                     []).append(inputfile)
+        funds = list(files_by_fund)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def verify(chunk):
+            async with semaphore:
+                isins = await lookup.resolve_async(chunk)
+            for fund in chunk:
+                if isins[fund] is None:
+                    logging.error('ISIN not found in'
+                                  ' public.v_etp_mkt_ibp_classification via'
+                                  ' Fund Name or Ticker for {}'.format(fund))
+                for inputfile in files_by_fund[fund]:
+                    self.futures[inputfile].set_result(
+                        isins[fund] is not None)
+
+        await asyncio.gather(*(verify(funds[i:i + self.chunk_size])
+                               for i in range(0, len(funds),
+                                              self.chunk_size)))
+
+    def verified(self, inputfile):
+        """Returns whether the fund of `inputfile` maps to an ISIN, waiting
+        for it to be resolved."""
+        return self.futures[inputfile].result()
+
+    def close(self):
+        self.thread.join()
+
+
+def section_names(grains):
+    """Returns the FDF section names that make up the provided grains."""
+    names = []
+    for grain in grains:
+        if isinstance(GRAINS[grain], list):
+            names.extend(GRAINS[grain])
+        else:
+            names.append(GRAINS[grain])
+    return names
+
+
+def resolve_grains(args_grain):
+    """Expands the runtime grain argument into a list of grains.
+
+    Example:
+        resolve_grains('fund,fx')
+        >>> ['fund', 'fx']
+    """
+    if args_grain == 'all':
+        return list(GRAINS.keys())
+    grains = [grain.strip() for grain in args_grain.split(',')]
+    for grain in grains:
+        confirm_grain_is_valid(grain)
+    return grains
+
+
+def resolve_outputfile(args_outputfile, grain, multigrain):
+    """Returns the output file for a grain. When more than one grain is
+    requested, `args_outputfile` is the directory to write to."""
+    if multigrain:
+        return os.path.join(args_outputfile, OUTPUT_FILENAME.format(grain))
+    return args_outputfile
+
+
+def extract_grain(sections, grain):
+    """Builds the rows to write for `grain` from raw section rows, with the
+    section grammar in SECTION_SCHEMAS.
+
+    The rows are the same as the original transpose(), format_date(),
+    format_header() and merge_holdings() chain builds, except that quoted
+    values may hold commas.
+
+    Args:
+        `sections`: A dict of section name to raw section rows
+        `grain`: A key in GRAINS
+
+    Returns:
+        `outfile_rows`: A list of strings, header first
+    """
+    return render_grain(grain, *parse_grain(sections, grain))
+
+
+class SectionSchema:
+    """Declarative layout of one FDF section, for read_section().
+
+    Layouts:
+        'keyvalue': One `key,value[,date]` row per field, read as a single
+        record. A date adds a `<key>_date` field after the key's value,
+        and values in MMM DD YYYY format are converted to YYYY-MM-DD
+        'table': A header row followed by one record per row
+        'rates': `currency,rate` rows below a `Base Currency` row, read
+        with the fixed `header`
+
+    Args:
+        `layout`: One of the layouts above
+        `header`: Column names for the 'rates' layout
+        `skip_last`: Drop the last row of a 'table', e.g. the aggregate
+        row at the end of Holdings: Securities
+        `header_delimiter`: Delimiter the header is written with
+    """
+
+    __slots__ = ('layout', 'header', 'skip_last', 'header_delimiter')
+
+    def __init__(self, layout, header=None, skip_last=False,
+                 header_delimiter='|'):
+        self.layout = layout
+        self.header = header
+        self.skip_last = skip_last
+        self.header_delimiter = header_delimiter
+
+
+# Section schemas, keyed like the values of GRAINS
+SECTION_SCHEMAS = {
+    'Fund Level': SectionSchema('keyvalue'),
+    'Basket Level': SectionSchema('keyvalue'),
+    'Swaps': SectionSchema('keyvalue'),
+    'Spreads': SectionSchema('table'),
+    'Allocation Details': SectionSchema('table'),
+    'FX Forwards': SectionSchema('table'),
+    'Holdings: Securities': SectionSchema('table', skip_last=True),
+    'Holdings: Synthetics': SectionSchema('table'),
+    # The fx header has always been written comma delimited
+    'FX Rates': SectionSchema('rates', header=['currency', 'spot_rate'],
+                              header_delimiter=','),
+    }
+
+
+class Columns:
+    """Column names shared by the records of a parsed section, with their
+    positions by name."""
+
+    __slots__ = ('names', 'positions')
+
+    def __init__(self, names):
+        self.names = names
+        self.positions = {name: i for i, name in enumerate(names)}
+
+
+class Record:
+    """One record of a parsed FDF section.
+
+    Values are kept as the strings read from the file. typed() converts
+    them the same way as columnar output, see typed_value().
+
+    Example:
+        record = Record(Columns(['fund_size']), ['15632440260.80'])
+        record['fund_size'], record.typed()
+        >>> ('15632440260.80', {'fund_size': 15632440260.8})
+    """
+
+    __slots__ = ('columns', 'values')
+
+    def __init__(self, columns, values):
+        self.columns = columns
+        self.values = values
+
+    def __getitem__(self, name):
+        return self.values[self.columns.positions[name]]
+
+    def typed(self):
+        """Returns a dict of column name to typed value."""
+        return {name: typed_value(name, value)
+                for name, value in zip(self.columns.names, self.values)}
+
+
+def normalize_column(name):
+    """Formats a column name the way format_header() does.
+
+    Example:
+        normalize_column(' Bid Spread')
+        >>> 'bid_spread'
+    """
+    return name.strip().lower().replace(' ', '_')
+
+
+def tokenize(rows):
+    """Splits comma delimited rows into lists of values with `csv`, so
+    quoted values may hold commas (and span rows).
+
+    Without a quote character in the section, csv.reader() and
+    str.split(',') split rows identically, so the faster split is used.
+
+    Example:
+        tokenize(['a,"b,c"', 'd'])
+        >>> [['a', 'b,c'], ['d']]
+    """
+    if any('"' in row for row in rows):
+        return list(csv.reader(rows))
+    return [row.split(',') for row in rows]
+
+
+def read_section(rows, schema):
+    """Reads the rows of one section as laid out by `schema`.
+
+    Returns:
+        `columns`, `body`: The section's Columns and a list of value lists
+    """
+    body = tokenize(rows)
+    if schema.layout == 'keyvalue':
+        names, values = [], []
+        for fields in body:
+            key = fields[0]
+            names.append(key)
+            values.append(fields[1] if len(fields) > 1 else '')
+            if len(fields) > 2:
+                names.append(key + '_date')
+                values.append(fields[2])
+        values = [(convert_date(value) or value)
+                  if DATE_PATTERN.match(value) else value
+                  for value in values]
+        return Columns([normalize_column(name) for name in names]), [values]
+
+    if schema.layout == 'rates':
+        columns = Columns(schema.header)
     else:
-        logging.basicConfig(level=logging.WARNING,
-                            format=LOG_FORMAT, datefmt=LOG_DATEFMT)
+        columns = Columns([normalize_column(name) for name in body[0]])
+    return columns, body[1:-1] if schema.skip_last else body[1:]
 
-    confirm_file_exists(args.inputfile)
-    confirm_grain_is_valid(args.grain)
-    confirm_valid_isin(args.inputfile)
-
-    # READ from inputfile
-    with open(args.inputfile, mode='r', encoding='utf-8-sig') as infile:
-        infile_rows = infile.read().split('\n')
-        f_position_date = confirm_valid_date(infile_rows)
-        logging.info('working on READ process for relevant grain ...'
-                     ' PROCESSING')
-        logging.info('opened {} for reading'
-                     .format(os.path.split(infile.name)[-1]))
-
-        # Holdings: Securities and Holdings: Synthetics
-        if args.grain == 'holdings':
-            holdings_parsed_rows = []
-            for i in range(len(GRAINS[args.grain])):
-                holdings_parsed_rows.append(parse_data(infile_rows,
-                                            GRAINS[args.grain][i],
-                                            ''))
-            outfile_rows = merge_holdings(holdings_parsed_rows)
-
-        # FX Rates
-        elif args.grain == 'fx':
-            fx_header = 'currency,spot_rate'
-            fx_rows = parse_data(infile_rows, GRAINS[args.grain], '')[1:]
-            fx_rows.insert(0, fx_header)
-            outfile_rows = fx_rows
-
-        # FX Forwards
-        elif args.grain == 'forwards':
-            outfile_rows = format_header(parse_data(infile_rows,
-                                                    GRAINS[args.grain], ''))
-        # Spreads and Allocation Details
-        elif args.grain in ['spreads', 'allocations']:
-            sp_al_rows = format_header(parse_data(infile_rows,
-                                                  GRAINS[args.grain], ''))
-            outfile_rows = [string.replace(',', '|') for string in sp_al_rows]
-
-        # Fund Level, Basket Level, and Swaps
+
+def merge_sections(sections):
+    """Merges sections read by read_section() into rows over the union of
+    their columns, in order of first appearance. Values of columns a
+    section does not have are ''. Value lists are padded in place.
+
+    Returns:
+        `columns`, `body`: As returned by read_section(), with `body` an
+        iterator over tuples of values, so merged rows can be formatted one
+        at a time
+    """
+    columns = Columns(list(dict.fromkeys(
+        name for section_columns, _ in sections
+        for name in section_columns.names)))
+    return columns, iter_merged(columns, sections)
+
+
+def iter_merged(columns, sections):
+    """Yields the rows of `sections` over `columns`, see merge_sections()."""
+    for section_columns, body in sections:
+        # Columns missing from this section point one past the end of the
+        # row, which is padded with ''
+        width = len(section_columns.names)
+        positions = [section_columns.names.index(name)
+                     if name in section_columns.positions else width
+                     for name in columns.names]
+        if len(positions) == 1:
+            def select(values, position=positions[0]):
+                return (values[position],)
         else:
-            outfile_rows = format_header(
-                format_date(
-                    transpose(
-                        parse_data(infile_rows, GRAINS[args.grain], ''))))
-
-        logging.info('{} lines prepped to write to {}'
-                     .format(len(outfile_rows), args.outputfile))
-        logging.debug('outfile_rows to write: {}'
-                      .format(outfile_rows))
-        logging.info('completed READ process for relevant grain ...'
-                     ' COMPLETE')
+            select = itemgetter(*positions)
+        for values in body:
+            if len(values) > width:
+                bailout('holdings row has {} values for {} columns: {}'
+                        .format(len(values), width, values))
+            values.extend([''] * (width + 1 - len(values)))
+            yield select(values)
+
+
+def parse_grain(sections, grain):
+    """Reads `grain` from raw section rows with the section grammar in
+    SECTION_SCHEMAS, in one pass over the rows. Grains spanning several
+    sections are merged with merge_sections().
 
-    # Check if writing header is required
-    with open(args.outputfile, mode='r') as checkfile:
-        informational_headers = 'source_category|source_name|f_position_date|'
-        header = informational_headers + outfile_rows[0] + '\n'
-        ignore_headers = False
+    Returns:
+        `columns`, `body`: The grain's Columns and an iterable of sequences
+        of values, one per row. See grain_records() for Records
+    """
+    names = section_names([grain])
+    if len(names) == 1:
+        return read_section(sections[names[0]], SECTION_SCHEMAS[names[0]])
+    return merge_sections([read_section(sections[name], SECTION_SCHEMAS[name])
+                           for name in names])
 
-        if header == checkfile.readline():
-            ignore_headers = True
 
-        logging.info('ignore_headers set to {}'.format(ignore_headers))
+def grain_records(sections, grain):
+    """Reads `grain` like parse_grain(), as a list of Records.
+
+    Example:
+        grain_records({'Fund Level': ['Fund Name,"iShares, Inc."',
+                                      'As Of,,Jan 22 2019']}, 'fund')
+        >>> [Record] with values ['iShares, Inc.', '', '2019-01-22'] for
+            columns ['fund_name', 'as_of', 'as_of_date']
+    """
+    columns, body = parse_grain(sections, grain)
+    return [Record(columns, values) for values in body]
+
+
+def render_grain(grain, columns, body):
+    """Formats a grain read by parse_grain() as the rows to write, header
+    first."""
+    schema = SECTION_SCHEMAS[section_names([grain])[0]]
+    delimiter = ',' if grain in COMMA_DELIMITED_GRAINS else '|'
+    outfile_rows = [schema.header_delimiter.join(columns.names)]
+    outfile_rows.extend([delimiter.join(values) for values in body])
+    return outfile_rows
+
+
+def numeric_array(values):
+    """Converts a list of equal length lists of strings to a 2D float64
+    NumPy array. Empty strings are read as 0.
+
+    Raises ValueError if a value is not a number.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        bailout('--reconcile requires numpy')
+    # float() on a flat list is faster than NumPy's own str to float cast
+    flat = [float(value) if value else 0.0
+            for row in values for value in row]
+    return np.array(flat, dtype=np.float64).reshape(len(values), -1)
+
+
+def reconcile_holdings(sections, tolerance=RECONCILE_TOLERANCE):
+    """Checks parsed holdings against the figures the FDF file states for
+    them.
+
+    (1) The Deliverable, Pricing and Excluded Basket Qty columns of Holdings:
+    Securities must sum to the aggregate last row that merge_holdings()
+    drops. (2) The pricing basket, sum(Pricing Basket Qty * Price) plus the
+    Basket Level Projected Cash for Pricing Basket, must be within
+    `tolerance` (relative) of Total NAV per Share * Shares per Basket (PNU).
+    The NAV is usually from the previous day, so some drift is expected.
+
+    Args:
+        `sections`: A dict of section name to raw rows, holding the
+        RECONCILE_SECTIONS found in the file
+        `tolerance`: Relative tolerance of the cash check
+
+    Returns:
+        `mismatches`: A list of strings describing each failed check
+    """
+    for name in RECONCILE_SECTIONS:
+        if name not in sections:
+            return ['section {} not found'.format(name)]
+    # The aggregate row is kept here, unlike in SECTION_SCHEMAS
+    columns, body = read_section(sections['Holdings: Securities'],
+                                 SectionSchema('table'))
+    if not body:
+        # Funds holding only synthetics or cash have no securities
+        return []
+    missing = [name for name in RECONCILE_COLUMNS
+               if name not in columns.positions]
+    if missing:
+        return ['Holdings: Securities has no {} column(s)'.format(missing)]
+    positions = [columns.positions[name] for name in RECONCILE_COLUMNS]
+    select = itemgetter(*positions)
+    # Rows may stop short of the price column, e.g. the aggregate row
+    width = max(positions) + 1
+    try:
+        values = numeric_array([select(row) if len(row) >= width
+                                else select(row + [''] * (width - len(row)))
+                                for row in body])
+    except ValueError as error:
+        return ['non-numeric holdings quantity or price: {}'.format(error)]
+
+    mismatches = []
+    # Quantities: the last three RECONCILE_COLUMNS
+    sums = values[:-1, 1:].sum(axis=0)
+    aggregate = values[-1, 1:]
+    for name, total, stated in zip(RECONCILE_COLUMNS[1:], sums, aggregate):
+        # Each quantity is rounded, so allow for the rounding to add up
+        if abs(total - stated) > 1e-3 + 1e-6 * abs(stated):
+            mismatches.append('{} sums to {:.5f}, aggregate row has {:.5f}'
+                              .format(name, total, stated))
+
+    fund = grain_records(sections, 'fund')[0].typed()
+    basket = grain_records(sections, 'basket')[0].typed()
+    nav = fund.get('total_nav_per_share')
+    pnu = basket.get('shares_per_basket_(pnu)')
+    cash = basket.get('projected_cash_for_pricing_basket')
+    if nav and pnu and cash is not None:
+        # price * pricing_basket_qty over the security rows
+        securities = values[:-1, 0] @ values[:-1, 2]
+        basket_value = nav * pnu
+        if abs(securities + cash - basket_value) > tolerance * basket_value:
+            mismatches.append('pricing basket of {:.2f} plus cash of {:.2f}'
+                              ' is off NAV * PNU of {:.2f} by more than'
+                              ' {:.2%}'.format(securities, cash,
+                                               basket_value, tolerance))
+    return mismatches
+
+
+def confirm_headers_match(outfile_rows, outputfile):
+    """Checks if the header of `outputfile` matches `outfile_rows`, in which
+    case rows are appended rather than (re)written."""
+    informational_headers = 'source_category|source_name|f_position_date|'
+    header = informational_headers + outfile_rows[0] + '\n'
+    ignore_headers = False
+    if os.path.isfile(outputfile):
+        with open(outputfile, mode='r') as checkfile:
+            if header == checkfile.readline():
+                ignore_headers = True
+    logging.info('ignore_headers set to {}'.format(ignore_headers))
+    return ignore_headers
+
+
+def format_body(outfile_rows, source_name, f_position_date):
+    """Returns the body rows of `outfile_rows` as one string, each row
+    prefixed with the informational columns.
+
+    Example:
+        format_body(['a|b', '1|2'], 'X.csv', '2019-01-22')
+        >>> 'iShares FTP|X.csv|2019-01-22|1|2\n'
+    """
+    if len(outfile_rows) < 2:
+        return ''
+    prefix = 'iShares FTP|{}|{}|'.format(source_name, f_position_date)
+    return prefix + ('\n' + prefix).join(outfile_rows[1:]) + '\n'
+
+
+def write_grain(outfile_rows, outputfile, source_name, f_position_date,
+                ignore_headers):
+    """Writes or appends `outfile_rows` to `outputfile`.
+
+    Rows are appended when `ignore_headers` is set, otherwise `outputfile`
+    is (re)written with a header. The body is formatted once and written in
+    a single call. A rewrite goes to `<outputfile>.tmp` first and is
+    renamed into place, so it is never seen half-written. An append that
+    raises part way is truncated back to the previous size; one that is
+    killed outright leaves a partial last row, which the output's
+    DuplicateIndex truncates away the next time it is opened.
+    """
+    informational_headers = 'source_category|source_name|f_position_date|'
+    header = informational_headers + outfile_rows[0] + '\n'
+    body = format_body(outfile_rows, source_name, f_position_date)
+
     if ignore_headers:
         # APPEND to outputfile
         logging.info('working on APPEND process for relevant grain ...'
                      ' PROCESSING')
-        confirm_no_duplicates(outfile_rows, args.outputfile)
-        with open(args.outputfile, mode='a') as outfile:
-            for i in range(1, len(outfile_rows[1:]) + 1):
-                outfile.write('iShares FTP|{}|{}|{}\n'
-                              .format(os.path.split(args.inputfile)[-1],
-                                      f_position_date,
-                                      outfile_rows[i]))
-        logging.info('appending data to {}'.format(args.outputfile))
+        with open(outputfile, mode='a') as outfile:
+            size = outfile.tell()
+            try:
+                outfile.write(body)
+                outfile.flush()
+            except BaseException:
+                outfile.truncate(size)
+                raise
+        logging.info('appending data to {}'.format(outputfile))
         logging.debug('appending body as: {}'.format(outfile_rows[1:]))
         logging.info('completed APPEND process for relevant grain ...'
                      ' COMPLETE')
@@ -526,24 +1655,1270 @@ def main():
         # WRITE to outputfile
         logging.info('working on WRITE process for relevant grain ...'
                      ' PROCESSING')
-        with open(args.outputfile, mode='w') as outfile:
-            outfile.write(header)
-            logging.debug('writing header as: {}'.format(header))
-            for i in range(1, len(outfile_rows[1:]) + 1):
-                outfile.write('iShares FTP|{}|{}|{}\n'
-                              .format(os.path.split(args.inputfile)[-1],
-                                      f_position_date,
-                                      outfile_rows[i]))
+        temp = outputfile + '.tmp'
+        try:
+            with open(temp, mode='w') as outfile:
+                outfile.write(header)
+                logging.debug('writing header as: {}'.format(header))
+                outfile.write(body)
+            os.replace(temp, outputfile)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
         logging.info('wrote {} lines to {}'
-                     .format(len(outfile_rows), args.outputfile))
+                     .format(len(outfile_rows), outputfile))
         logging.debug('wrote {} lines to {}: {}'
                       .format(len(outfile_rows),
-                              args.outputfile,
+                              outputfile,
                               outfile_rows[1:]))
         logging.info('completed WRITE process for relevant grain ...'
                      ' COMPLETE')
-        logging.info('--- SUCCESS --- total elapsed time: {} seconds'
-                     .format(time() - START))
+
+
+def split_outfile_rows(grain, outfile_rows):
+    """Splits the rows built for a grain into a header and lists of values.
+
+    Example:
+        split_outfile_rows('fx', ['currency,spot_rate', 'JPY,0.009137'])
+        >>> (['currency', 'spot_rate'], [['JPY', '0.009137']])
+    """
+    delimiter = ',' if grain in COMMA_DELIMITED_GRAINS else '|'
+    header = outfile_rows[0].replace(',', '|').split('|')
+    rows = [row.split(delimiter) for row in outfile_rows[1:]]
+    for row in rows:
+        if len(row) != len(header):
+            bailout('{} values for {} columns in {} row: {}'
+                    .format(len(row), len(header), grain, row))
+    return header, rows
+
+
+def typed_value(column, value):
+    """Converts a value to the type stored for `column` in columnar output.
+
+    Empty strings and values that do not parse become None.
+
+    Example:
+        typed_value('fund_size', '15632440260.80')
+        >>> 15632440260.8
+    """
+    if value == '':
+        return None
+    if column in NUMERIC_COLUMNS:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    if column.endswith('_date'):
+        for date_format in ('%Y-%m-%d', '%Y%m%d'):
+            try:
+                return datetime.strptime(value, date_format).date()
+            except ValueError:
+                pass
+        return None
+    return value
+
+
+def columnar_part(args_outputfile, grain, f_position_date, source_name,
+                  output_format):
+    """Returns the path of the columnar part file for one grain of one input
+    file. Parts are partitioned by f_position_date, hive style."""
+    return os.path.join(args_outputfile,
+                        OUTPUT_DATASET.format(grain),
+                        'f_position_date={}'.format(f_position_date),
+                        source_name + OUTPUT_FORMATS[output_format])
+
+
+def write_columnar(outfile_rows, grain, part, source_name, output_format):
+    """Writes one grain of one input file as a typed columnar part file.
+
+    Numeric columns are stored as float64 and date columns as date32. The
+    part is written to a temporary file and renamed into place, so readers
+    never see a partial part and existing partitions are never rewritten.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        bailout('--output-format {} requires pyarrow'.format(output_format))
+
+    header, rows = split_outfile_rows(grain, outfile_rows)
+    columns = {'source_category': pa.array(['iShares FTP'] * len(rows)),
+               'source_name': pa.array([source_name] * len(rows))}
+    for i, column in enumerate(header):
+        if column in NUMERIC_COLUMNS:
+            arrow_type = pa.float64()
+        elif column.endswith('_date'):
+            arrow_type = pa.date32()
+        else:
+            arrow_type = pa.string()
+        columns[column] = pa.array([typed_value(column, row[i])
+                                    for row in rows], type=arrow_type)
+    table = pa.table(columns)
+
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    temp = part + '.tmp'
+    if output_format == 'parquet':
+        pq.write_table(table, temp)
+    else:
+        # Uncompressed Arrow IPC files can be memory-mapped zero-copy
+        with pa.OSFile(temp, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    os.replace(temp, part)
+    logging.info('wrote {} rows to {}'.format(len(rows), part))
+
+
+def write_grains(outfile_rows_by_grain, args_outputfile, source_name,
+                 f_position_date, duplicate_indexes=None, output_format='ff',
+                 multigrain=None, metrics=None, written=None):
+    """Writes every grain parsed from one input file.
+
+    Each grain is checked for duplicates and written on its own, so a grain
+    that fails its duplicate check does not hold back the others, the same
+    as running each grain separately. For columnar output formats, a grain
+    is a duplicate if its part already exists.
+
+    Args:
+        `duplicate_indexes`: An optional dict of output file to open
+        DuplicateIndex, reused across calls in batch mode
+        `output_format`: A key in OUTPUT_FORMATS
+        `multigrain`: Whether more than one grain was requested, which makes
+        `args_outputfile` a directory. Defaults to whether
+        `outfile_rows_by_grain` holds more than one grain
+        `metrics`: An optional FileMetrics to time the duplicate_check and
+        write stages on
+        `written`: An optional list, extended with every grain written, so
+        callers can tell which grains made it when this bails out
+
+    Returns:
+        `written`: The grains written. bailout() after all other grains are
+        written if any grain failed
+    """
+    if metrics is None:
+        metrics = FileMetrics(source_name)
+    if written is None:
+        written = []
+    if multigrain is None:
+        multigrain = len(outfile_rows_by_grain) > 1
+    opened = duplicate_indexes is None
+    if opened:
+        duplicate_indexes = {}
+    failed = []
+    try:
+        for grain, outfile_rows in outfile_rows_by_grain.items():
+            try:
+                if output_format != 'ff':
+                    write_columnar_grain(outfile_rows, args_outputfile,
+                                         grain, source_name,
+                                         f_position_date, output_format,
+                                         metrics)
+                else:
+                    write_flat_grain(outfile_rows, args_outputfile, grain,
+                                     source_name, f_position_date,
+                                     duplicate_indexes, multigrain,
+                                     metrics)
+            except SystemExit:
+                # Already logged by bailout()
+                failed.append(grain)
+                continue
+            written.append(grain)
+    finally:
+        if opened:
+            for index in duplicate_indexes.values():
+                index.close()
+    if failed:
+        bailout('grain(s) {} of {} failed, grain(s) {} written'
+                .format(failed, source_name, written))
+    return written
+
+
+def write_columnar_grain(outfile_rows, args_outputfile, grain, source_name,
+                         f_position_date, output_format, metrics):
+    """Writes one grain for write_grains() as a columnar part, unless the
+    part already exists."""
+    part = columnar_part(args_outputfile, grain, f_position_date,
+                         source_name, output_format)
+    with metrics.stage('duplicate_check'):
+        if os.path.exists(part):
+            bailout('{} has already been written'.format(part))
+    with metrics.stage('write'):
+        write_columnar(outfile_rows, grain, part, source_name, output_format)
+
+
+def write_flat_grain(outfile_rows, args_outputfile, grain, source_name,
+                     f_position_date, duplicate_indexes, multigrain,
+                     metrics):
+    """Writes one grain for write_grains() to its flat file output, after
+    checking rows to append against the output's DuplicateIndex."""
+    outputfile = resolve_outputfile(args_outputfile, grain, multigrain)
+    with metrics.stage('duplicate_check'):
+        if outputfile not in duplicate_indexes:
+            duplicate_indexes[outputfile] = DuplicateIndex(outputfile)
+        ignore_headers = confirm_headers_match(outfile_rows, outputfile)
+        if ignore_headers:
+            confirm_no_duplicates(outfile_rows, outputfile,
+                                  duplicate_indexes[outputfile])
+    with metrics.stage('write'):
+        write_grain(outfile_rows, outputfile, source_name, f_position_date,
+                    ignore_headers)
+        duplicate_indexes[outputfile].add(outfile_rows[1:],
+                                          reset=not ignore_headers)
+
+
+def part_path(args_outputfile, grain, multigrain, source_name):
+    """Returns the part file written by --writer sharded for one grain of
+    one input file, in the `<outputfile>.parts` directory next to the
+    grain's output file."""
+    outputfile = resolve_outputfile(args_outputfile, grain, multigrain)
+    return os.path.join(outputfile + PART_DIRECTORY_SUFFIX, source_name)
+
+
+def write_part(outfile_rows, part, source_name, f_position_date):
+    """Writes one grain of one input file as a part file, laid out exactly
+    like a freshly written output file: header, then the formatted body.
+
+    The part is written to a temporary file and renamed into place, so
+    PartMerger never sees a partial part.
+    """
+    informational_headers = 'source_category|source_name|f_position_date|'
+    header = informational_headers + outfile_rows[0] + '\n'
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    temp = part + '.tmp'
+    with open(temp, mode='w') as outfile:
+        outfile.write(header)
+        outfile.write(format_body(outfile_rows, source_name,
+                                  f_position_date))
+    os.replace(temp, part)
+    logging.info('wrote {} lines to {}'.format(len(outfile_rows), part))
+
+
+def merge_part(part, outputfile, append):
+    """Moves a part file into `outputfile`.
+
+    With `append`, the body of the part is appended to `outputfile`, and an
+    append that fails part way is truncated back to the previous size, as
+    in write_grain().
+    Otherwise the part, header included, replaces `outputfile` with a
+    rename.
+    """
+    if not append:
+        os.replace(part, outputfile)
+        logging.info('moved {} to {}'.format(part, outputfile))
+        return
+    with open(part, mode='rb') as infile, \
+            open(outputfile, mode='ab') as outfile:
+        infile.readline()
+        size = outfile.tell()
+        try:
+            shutil.copyfileobj(infile, outfile)
+            outfile.flush()
+        except BaseException:
+            outfile.truncate(size)
+            raise
+    logging.info('appended {} to {}'.format(part, outputfile))
+
+
+class PartMerger:
+    """Merges the part files written by --writer sharded workers into the
+    output file of each grain.
+
+    Files are merged one at a time, in input file order, with the same
+    per-grain header and duplicate checks as write_grains(): a part whose
+    header matches the output is appended if none of its rows are already
+    in the output, any other part replaces the output. The result is the
+    same as writing every file directly, but each output's header is read
+    once and its DuplicateIndex stays open for the whole batch. Merged and
+    discarded parts are removed.
+    """
+
+    def __init__(self, args_outputfile, multigrain):
+        self.args_outputfile = args_outputfile
+        self.multigrain = multigrain
+        self.headers = {}
+        self.duplicate_indexes = {}
+
+    def _header(self, outputfile):
+        """Returns the header line of `outputfile`, or None if it does not
+        exist yet."""
+        if outputfile not in self.headers:
+            header = None
+            if os.path.isfile(outputfile):
+                with open(outputfile, mode='r') as checkfile:
+                    header = checkfile.readline()
+            self.headers[outputfile] = header
+        return self.headers[outputfile]
+
+    def merge(self, parts_by_grain, metrics, written=None):
+        """Merges the parts of one input file, a dict of grain to part file.
+
+        Each grain is checked and merged on its own, like write_grains(), so
+        a grain with duplicates does not hold back the others. `written` is
+        an optional list, extended with every grain merged.
+
+        Returns:
+            `written`: The grains merged. bailout() after all other grains
+            are merged if any grain had duplicates
+        """
+        if written is None:
+            written = []
+        failed = []
+        try:
+            for grain, part in parts_by_grain.items():
+                try:
+                    self.merge_grain(grain, part, metrics)
+                except SystemExit:
+                    # Already logged by bailout()
+                    failed.append(grain)
+                    continue
+                written.append(grain)
+        finally:
+            self.discard(parts_by_grain)
+        if failed:
+            bailout('grain(s) {} of {} failed, grain(s) {} merged'
+                    .format(failed, metrics.source_name, written))
+        return written
+
+    def merge_grain(self, grain, part, metrics):
+        """Merges the part of one grain into its output file."""
+        outputfile = resolve_outputfile(self.args_outputfile, grain,
+                                        self.multigrain)
+        with metrics.stage('duplicate_check'):
+            if outputfile not in self.duplicate_indexes:
+                self.duplicate_indexes[outputfile] = DuplicateIndex(outputfile)
+            with open(part, mode='r') as infile:
+                header = infile.readline()
+                # Rows without the informational columns
+                rows = [line.rstrip('\n').split('|', 3)[3] for line in infile]
+            append = header == self._header(outputfile)
+            if append:
+                confirm_no_duplicates([header] + rows, outputfile,
+                                      self.duplicate_indexes[outputfile])
+        with metrics.stage('merge'):
+            merge_part(part, outputfile, append)
+            self.headers[outputfile] = header
+            self.duplicate_indexes[outputfile].add(rows, reset=not append)
+
+    def discard(self, parts_by_grain):
+        """Removes the parts of an input file that is not merged."""
+        for part in parts_by_grain.values():
+            if os.path.exists(part):
+                os.remove(part)
+
+    def close(self):
+        for index in self.duplicate_indexes.values():
+            index.close()
+        for grain in GRAINS:
+            outputfile = resolve_outputfile(self.args_outputfile, grain,
+                                            self.multigrain)
+            try:
+                os.rmdir(outputfile + PART_DIRECTORY_SUFFIX)
+            except OSError:
+                # Not there, or holds parts of files that failed to parse
+                pass
+
+
+def read_inputfile(inputfile, grains, reader='stream',
+                   reconcile=False, reconcile_tolerance=RECONCILE_TOLERANCE,
+                   metrics=None):
+    """Reads one FDF file and builds the rows to write for every grain.
+
+    The file is streamed section by section with read_sections(), using
+    `reader`. Each grain is built with extract_grain() as soon as all of its
+    sections have been read, after which the raw section rows are released.
+    With `reconcile`, holdings are also checked with reconcile_holdings()
+    and mismatches are logged as warnings. Stage timings, row counts and
+    mismatches are recorded on `metrics`, an optional FileMetrics.
+
+    Returns:
+        `f_position_date`, `outfile_rows_by_grain`: The validated position
+        date and a dict of grain to a list of strings, header first
+    """
+    if metrics is None:
+        metrics = FileMetrics(os.path.split(inputfile)[-1])
+    names = section_names(grains)
+    pending = list(grains)
+    sections = {}
+    wanted = set(names) | {'Fund Level'}
+    reconcile_sections = {}
+    if reconcile:
+        wanted.update(RECONCILE_SECTIONS)
+    f_position_date = None
+    outfile_rows_by_grain = {}
+
+    # READ from inputfile, one section at a time
+    logging.info('working on READ process for grain(s) {} ...'
+                 ' PROCESSING'.format(grains))
+    logging.info('opened {} for reading'
+                 .format(os.path.split(inputfile)[-1]))
+    section_iter = read_sections(inputfile, wanted, reader)
+    try:
+        while True:
+            with metrics.stage('read'):
+                section = next(section_iter, None)
+            if section is None:
+                break
+            name, rows = section
+            if name == 'Fund Level':
+                with metrics.stage('date_validation'):
+                    f_position_date = confirm_valid_fund_dates(rows)
+            if name in names:
+                sections[name] = rows
+            if reconcile and name in RECONCILE_SECTIONS:
+                reconcile_sections[name] = rows
+
+            for grain in list(pending):
+                grain_names = section_names([grain])
+                if all(name in sections for name in grain_names):
+                    with metrics.stage('transform'):
+                        outfile_rows = extract_grain(sections, grain)
+                    metrics.count(grain,
+                                  sum(len(sections[grain_name])
+                                      for grain_name in grain_names),
+                                  len(outfile_rows) - 1)
+                    logging.info('{} lines prepped to write for grain {}'
+                                 .format(len(outfile_rows), grain))
+                    logging.debug('outfile_rows to write: {}'
+                                  .format(outfile_rows))
+                    outfile_rows_by_grain[grain] = outfile_rows
+                    pending.remove(grain)
+                    for grain_name in grain_names:
+                        del sections[grain_name]
+    finally:
+        section_iter.close()
+
+    if f_position_date is None:
+        bailout('search string Fund Level not found')
+    for name in section_names(pending):
+        if name not in sections:
+            bailout('search string {} not found'.format(name))
+    if reconcile:
+        with metrics.stage('reconcile'):
+            mismatches = reconcile_holdings(reconcile_sections,
+                                            reconcile_tolerance)
+        for mismatch in mismatches:
+            logging.warning('reconciliation mismatch in {}: {}'
+                            .format(metrics.source_name, mismatch))
+        metrics.mismatches.extend(mismatches)
+    logging.info('completed READ process for grain(s) {} ...'
+                 ' COMPLETE'.format(grains))
+    metrics.f_position_date = f_position_date
+    return f_position_date, {grain: outfile_rows_by_grain[grain]
+                             for grain in grains}
+
+
+def file_digest(inputfile):
+    """Returns a hex digest of the contents of `inputfile`."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(inputfile, mode='rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Journal of input files that were successfully written, per grain.
+
+    Stored as a SQLite database. Each entry records the content hash,
+    source_name, f_position_date and grain of an input file, the output it
+    was written to, and the inode and size of the file holding its rows
+    (the output file, or the part of a columnar dataset) right after the
+    write. Reruns skip grains whose input is unchanged and whose rows are
+    still there, and reprocess new or modified files, and files whose
+    output was since deleted, truncated or replaced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('create table if not exists manifest'
+                                ' (source_name text, grain text,'
+                                ' output text, content_hash text,'
+                                ' f_position_date text, written real,'
+                                ' artifact text, artifact_inode integer,'
+                                ' artifact_size integer,'
+                                ' primary key (source_name, grain, output))')
+        # Manifests written before the artifact columns existed
+        columns = {row[1] for row in self.connection.execute(
+            'pragma table_info(manifest)')}
+        for column, column_type in [('artifact', 'text'),
+                                    ('artifact_inode', 'integer'),
+                                    ('artifact_size', 'integer')]:
+            if column not in columns:
+                self.connection.execute(
+                    'alter table manifest add column {} {}'
+                    .format(column, column_type))
+
+    def pending(self, source_name, content_hash, outputs_by_grain):
+        """Returns the grains of `outputs_by_grain` that have not been
+        written from this exact input yet, or whose rows are no longer in
+        their output."""
+        pending = []
+        for grain, output in outputs_by_grain.items():
+            row = self.connection.execute(
+                'select content_hash, artifact, artifact_inode,'
+                ' artifact_size from manifest where source_name = ?'
+                ' and grain = ? and output = ?',
+                (source_name, grain, output)).fetchone()
+            if row is None:
+                pending.append(grain)
+                continue
+            if row[0] != content_hash:
+                logging.warning('{} changed since it was written to {},'
+                                ' reprocessing'.format(source_name, output))
+                pending.append(grain)
+                continue
+            change = self.artifact_change(row[1] or output, row[2], row[3])
+            if change is not None:
+                logging.warning('{} was written to {}, which {} since,'
+                                ' reprocessing'
+                                .format(source_name, row[1] or output,
+                                        change))
+                pending.append(grain)
+        return pending
+
+    @staticmethod
+    def artifact_change(artifact, inode, size):
+        """Returns how `artifact` changed since it had `inode` and `size`,
+        or None if it still holds everything written to it. Entries
+        without a recorded inode are only checked for existence."""
+        if not os.path.exists(artifact):
+            return 'was deleted'
+        if inode is None:
+            return None
+        stat = os.stat(artifact)
+        if stat.st_ino != inode:
+            return 'was replaced'
+        if stat.st_size < size:
+            return 'was truncated'
+        return None
+
+    def record(self, source_name, content_hash, f_position_date,
+               outputs_by_grain, artifacts_by_grain=None):
+        """Records grains of an input file as successfully written.
+
+        Args:
+            `artifacts_by_grain`: An optional dict of grain to the file
+            holding its rows, if that is not the output itself
+        """
+        if artifacts_by_grain is None:
+            artifacts_by_grain = outputs_by_grain
+        now = time()
+        entries = []
+        for grain, output in outputs_by_grain.items():
+            artifact = artifacts_by_grain[grain]
+            stat = os.stat(artifact)
+            entries.append((source_name, grain, output, content_hash,
+                            f_position_date, now, artifact, stat.st_ino,
+                            stat.st_size))
+        self.connection.executemany(
+            'insert or replace into manifest values'
+            ' (?, ?, ?, ?, ?, ?, ?, ?, ?)', entries)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class FileMetrics:
+    """Per-stage timings and per-grain row counts for one input file.
+
+    Stages are named after STAGES. Instances hold plain data only, so
+    --batch workers can return them to the writer process.
+    """
+
+    def __init__(self, source_name):
+        self.source_name = source_name
+        self.status = 'ok'
+        self.f_position_date = None
+        self.stages = {}
+        self.rows = {}
+        self.mismatches = []
+
+    @contextmanager
+    def stage(self, name):
+        """Adds the time spent in the with block to stage `name`."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = (self.stages.get(name, 0.0)
+                                 + perf_counter() - start)
+
+    def count(self, grain, rows_in, rows_out):
+        """Records the section rows read and data rows built for a grain."""
+        self.rows[grain] = {'in': rows_in, 'out': rows_out}
+
+    def record(self):
+        """Returns the JSON metrics record for this file."""
+        return {'record': 'file',
+                'source_name': self.source_name,
+                'status': self.status,
+                'f_position_date': self.f_position_date,
+                'stages': {name: round(seconds, 6)
+                           for name, seconds in self.stages.items()},
+                'rows': self.rows,
+                'mismatches': self.mismatches}
+
+
+class MetricsWriter:
+    """Collects the FileMetrics of a run and reports them.
+
+    Each file's record is appended to `path` as a JSON line as soon as it is
+    added, and a summary record with run totals follows on close(). With
+    `prometheus_path`, the run totals are also written in the Prometheus
+    textfile collector format, replacing the previous run's file. Stage
+    totals are always logged at INFO level.
+    """
+
+    def __init__(self, path=None, prometheus_path=None):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.files = {}
+        self.stages = {}
+        self.rows = {}
+        self.mismatched = 0
+        self.start = perf_counter()
+        self.outfile = None
+        if path is not None:
+            self.outfile = open(path, mode='a')
+
+    def add(self, metrics):
+        """Adds the metrics of one input file."""
+        self.files[metrics.status] = self.files.get(metrics.status, 0) + 1
+        if metrics.mismatches:
+            self.mismatched += 1
+        for name, seconds in metrics.stages.items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        for grain, counts in metrics.rows.items():
+            totals = self.rows.setdefault(grain, {'in': 0, 'out': 0})
+            totals['in'] += counts['in']
+            totals['out'] += counts['out']
+        if self.outfile is not None:
+            self.outfile.write(json.dumps(metrics.record()) + '\n')
+            self.outfile.flush()
+
+    def summary(self):
+        """Returns the JSON summary record for the run."""
+        return {'record': 'run',
+                'finished': time(),
+                'seconds': round(perf_counter() - self.start, 6),
+                'files': self.files,
+                'mismatched_files': self.mismatched,
+                'stages': {name: round(self.stages[name], 6)
+                           for name in STAGES if name in self.stages},
+                'rows': self.rows}
+
+    def prometheus(self, summary):
+        """Returns `summary` in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, help_text, samples):
+            name = METRICS_PREFIX + name
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in samples:
+                labels = ','.join('{}="{}"'.format(key, label)
+                                  for key, label in labels)
+                lines.append('{}{} {}'.format(
+                    name, '{' + labels + '}' if labels else '', value))
+
+        metric('_last_run_timestamp_seconds',
+               'Time the last run finished',
+               [((), summary['finished'])])
+        metric('_run_seconds', 'Duration of the last run',
+               [((), summary['seconds'])])
+        metric('_files', 'Input files by status in the last run',
+               [((('status', status),), count)
+                for status, count in sorted(summary['files'].items())])
+        metric('_mismatched_files',
+               'Input files with --reconcile mismatches in the last run',
+               [((), summary['mismatched_files'])])
+        metric('_stage_seconds', 'Seconds spent per stage in the last run',
+               [((('stage', name),), seconds)
+                for name, seconds in summary['stages'].items()])
+        metric('_rows', 'Rows read and built per grain in the last run',
+               [((('grain', grain), ('direction', direction)), count)
+                for grain, counts in sorted(summary['rows'].items())
+                for direction, count in sorted(counts.items())])
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        """Writes the run summary and closes the metrics outputs."""
+        summary = self.summary()
+        logging.info('stage totals: {}, files: {}'
+                     .format(summary['stages'], summary['files']))
+        if self.outfile is not None:
+            self.outfile.write(json.dumps(summary) + '\n')
+            self.outfile.close()
+        self.write_prometheus(summary)
+
+    def write_prometheus(self, summary):
+        """Writes `summary` to `prometheus_path`, if set."""
+        if self.prometheus_path is None:
+            return
+        # Written to a temp file and renamed, so the textfile collector
+        # never reads a partial file
+        temp = self.prometheus_path + '.tmp'
+        with open(temp, mode='w') as outfile:
+            outfile.write(self.prometheus(summary))
+        os.replace(temp, self.prometheus_path)
+
+
+def find_inputfiles(args_batch):
+    """Returns a sorted list of FDF files in a directory or matching a glob
+    pattern."""
+    if os.path.isdir(args_batch):
+        inputfiles = [os.path.join(args_batch, name)
+                      for name in os.listdir(args_batch)
+                      if name.upper().endswith('FDF.CSV')]
+    else:
+        inputfiles = glob.glob(args_batch)
+    if not inputfiles:
+        bailout('no input files found for batch: {}'.format(args_batch))
+    logging.info('found {} input files for batch: {}'
+                 .format(len(inputfiles), args_batch))
+    return sorted(inputfiles)
+
+
+class DropWatcher:
+    """Polls a drop directory for FDF files.
+
+    A file is handed out once its size and mtime are the same on two polls
+    in a row, so files still being copied in are left alone. It is handed
+    out again only if it changes after being processed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.seen = {}
+        self.processed = {}
+
+    def poll(self):
+        """Returns a sorted list of new or changed FDF files that are no
+        longer being written to."""
+        current = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if (not entry.name.upper().endswith('FDF.CSV')
+                        or not entry.is_file()):
+                    continue
+                stat = entry.stat()
+                current[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        ready = [path for path, stat in current.items()
+                 if self.seen.get(path) == stat
+                 and self.processed.get(path) != stat]
+        self.seen = current
+        return sorted(ready)
+
+    def done(self, inputfile):
+        """Marks a file returned by poll() as processed."""
+        self.processed[inputfile] = self.seen[inputfile]
+
+
+class StatusServer:
+    """Serves the state of a --watch run over HTTP, on 127.0.0.1 only, from
+    a daemon thread.
+
+    GET /status returns `status()` as JSON. GET /metrics returns
+    `metrics()`, the Prometheus text exposition format.
+    """
+
+    def __init__(self, port, status, metrics):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/status':
+                    body = json.dumps(status(), indent=2) + '\n'
+                    content_type = 'application/json'
+                elif self.path == '/metrics':
+                    body = metrics()
+                    content_type = 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('status request: ' + format % args)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='status-server', daemon=True)
+        self.thread.start()
+        logging.info('serving /status and /metrics on 127.0.0.1:{}'
+                     .format(self.port))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def process_file(task):
+    """Worker for --batch mode. Parses one input file.
+
+    bailout() exits with SystemExit, which would kill a pool worker and
+    hang the pool, so it is caught here and reported as a failed file.
+
+    Args:
+        `task`: A tuple of (inputfile, grains, options, part_output), where
+        options is a dict of keyword arguments for read_inputfile(), and
+        part_output is None, or a tuple of (args_outputfile, multigrain)
+        with --writer sharded
+
+    Returns:
+        `result`: A tuple of (inputfile, f_position_date,
+        outfile_rows_by_grain, metrics). The middle two are None if the file
+        failed. With `part_output`, a dict of grain to the part file written
+        by write_part() is returned in place of outfile_rows_by_grain.
+        `metrics` is the file's FileMetrics.
+    """
+    inputfile, grains, options, part_output = task
+    source_name = os.path.split(inputfile)[-1]
+    metrics = FileMetrics(source_name)
+    try:
+        f_position_date, outfile_rows_by_grain = read_inputfile(
+            inputfile, grains, metrics=metrics, **options)
+    except SystemExit:
+        metrics.status = 'failed'
+        return inputfile, None, None, metrics
+    if part_output is None:
+        return inputfile, f_position_date, outfile_rows_by_grain, metrics
+
+    args_outputfile, multigrain = part_output
+    parts = {}
+    with metrics.stage('write'):
+        for grain, outfile_rows in outfile_rows_by_grain.items():
+            parts[grain] = part_path(args_outputfile, grain, multigrain,
+                                     source_name)
+            write_part(outfile_rows, parts[grain], source_name,
+                       f_position_date)
+    return inputfile, f_position_date, parts, metrics
+
+
+def grain_outputs(args, grains):
+    """Returns a dict of grain to the absolute output path it is written to,
+    as recorded in the Manifest."""
+    multigrain = len(grains) > 1
+    outputs = {}
+    for grain in grains:
+        if args.output_format == 'ff':
+            output = resolve_outputfile(args.outputfile, grain, multigrain)
+        else:
+            output = os.path.join(args.outputfile,
+                                  OUTPUT_DATASET.format(grain))
+        outputs[grain] = os.path.abspath(output)
+    return outputs
+
+
+def grain_artifacts(args, grains, multigrain, source_name, f_position_date):
+    """Returns a dict of grain to the file holding the rows one input file
+    wrote for it: the output file, or the file's columnar part."""
+    artifacts = {}
+    for grain in grains:
+        if args.output_format == 'ff':
+            artifact = resolve_outputfile(args.outputfile, grain, multigrain)
+        else:
+            artifact = columnar_part(args.outputfile, grain, f_position_date,
+                                     source_name, args.output_format)
+        artifacts[grain] = os.path.abspath(artifact)
+    return artifacts
+
+
+def open_manifest(args):
+    """Returns the Manifest configured by the command line arguments, or
+    None with --nomanifest."""
+    if args.nomanifest:
+        return None
+    path = args.manifest
+    if path is None:
+        directory = args.outputfile
+        if not os.path.isdir(directory):
+            directory = os.path.dirname(os.path.abspath(directory))
+        path = os.path.join(directory, MANIFEST_FILENAME)
+    return Manifest(path)
+
+
+def plan_inputfiles(inputfiles, manifest, outputs_by_grain):
+    """Hashes every input file and drops grains already written from
+    identical contents.
+
+    Returns:
+        `plan`: A list of (inputfile, content_hash, pending grains) for
+        every input file with at least one pending grain
+    """
+    plan = []
+    for inputfile in inputfiles:
+        source_name = os.path.split(inputfile)[-1]
+        content_hash = file_digest(inputfile)
+        pending = list(outputs_by_grain)
+        if manifest is not None:
+            pending = manifest.pending(source_name, content_hash,
+                                       outputs_by_grain)
+        if pending:
+            plan.append((inputfile, content_hash, pending))
+        else:
+            logging.info('{} already written for grain(s) {}, skipping'
+                         .format(source_name, list(outputs_by_grain)))
+    return plan
+
+
+def read_options(args):
+    """Returns the keyword arguments for read_inputfile() set by the command
+    line arguments."""
+    return {'reader': args.reader,
+            'reconcile': args.reconcile,
+            'reconcile_tolerance': args.reconcile_tolerance}
+
+
+def open_metrics(args):
+    """Returns the MetricsWriter configured by the command line
+    arguments."""
+    return MetricsWriter(args.metrics, args.prometheus)
+
+
+def make_isin_lookup(args):
+    """Builds the IsinLookup configured by the command line arguments."""
+    return IsinLookup(AeonQueryBackend(args.query_command,
+                                       args.query_delimiter),
+                      args.isin_cache, args.isin_ttl)
+
+
+def run_batch(args, grains):
+    """Parses every file of a batch in a process pool and writes the results
+    from this (single writer) process in sorted input file order.
+
+    Files already written according to the Manifest are skipped before
+    anything else happens. ISINs for the rest of the batch are verified by
+    an IsinVerifier while the pool parses, and each file is written once
+    both are done. With --writer sharded, the workers write part files and
+    this process only merges them with a PartMerger.
+    """
+    inputfiles = find_inputfiles(args.batch)
+    outputs_by_grain = grain_outputs(args, grains)
+    manifest = open_manifest(args)
+    metrics = open_metrics(args)
+    plan = plan_inputfiles(inputfiles, manifest, outputs_by_grain)
+    content_hashes = {inputfile: content_hash
+                      for inputfile, content_hash, _ in plan}
+    pending_grains = {inputfile: pending for inputfile, _, pending in plan}
+    for inputfile in inputfiles:
+        if inputfile not in content_hashes:
+            skipped = FileMetrics(os.path.split(inputfile)[-1])
+            skipped.status = 'skipped'
+            metrics.add(skipped)
+
+    options = read_options(args)
+    multigrain = len(grains) > 1
+    merger = None
+    part_output = None
+    if args.writer == 'sharded':
+        merger = PartMerger(args.outputfile, multigrain)
+        part_output = (args.outputfile, multigrain)
+    tasks = [(inputfile, pending_grains[inputfile], options, part_output)
+             for inputfile in content_hashes]
+    failed = []
+
+    workers = max(1, min(args.workers, len(tasks)))
+    logging.info('processing {} files with {} worker(s)'
+                 .format(len(tasks), workers))
+    if workers == 1:
+        results = map(process_file, tasks)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(process_file, tasks)
+    # Started after the pool, so no worker is forked while the verifier
+    # thread is running
+    verifier = IsinVerifier(list(content_hashes),
+                            lambda: make_isin_lookup(args),
+                            args.isin_concurrency)
+
+    duplicate_indexes = {}
+    try:
+        for (inputfile, f_position_date, outfile_rows_by_grain,
+             file_metrics) in results:
+            source_name = os.path.split(inputfile)[-1]
+            with file_metrics.stage('isin_check'):
+                verified = verifier.verified(inputfile)
+            if not verified:
+                failed.append(source_name)
+                file_metrics.status = 'failed'
+                metrics.add(file_metrics)
+                if merger is not None and outfile_rows_by_grain:
+                    merger.discard(outfile_rows_by_grain)
+                continue
+            if outfile_rows_by_grain is None:
+                failed.append(source_name)
+                metrics.add(file_metrics)
+                continue
+            written = []
+            try:
+                if merger is not None:
+                    merger.merge(outfile_rows_by_grain, file_metrics, written)
+                else:
+                    write_grains(outfile_rows_by_grain, args.outputfile,
+                                 source_name, f_position_date,
+                                 duplicate_indexes, args.output_format,
+                                 multigrain, file_metrics, written)
+            except SystemExit:
+                failed.append(source_name)
+                file_metrics.status = 'failed'
+            finally:
+                metrics.add(file_metrics)
+                # Grains written before another grain failed are recorded,
+                # so a rerun only retries the grains that failed
+                if manifest is not None and written:
+                    manifest.record(source_name, content_hashes[inputfile],
+                                    f_position_date,
+                                    {grain: outputs_by_grain[grain]
+                                     for grain in written},
+                                    grain_artifacts(args, written,
+                                                    multigrain, source_name,
+                                                    f_position_date))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        verifier.close()
+        for index in duplicate_indexes.values():
+            index.close()
+        if merger is not None:
+            merger.close()
+        if manifest is not None:
+            manifest.close()
+        metrics.close()
+
+    if failed:
+        bailout('{} of {} files failed: {}'
+                .format(len(failed), len(inputfiles), failed))
+    logging.info('processed {} of {} files'
+                 .format(len(tasks), len(inputfiles)))
+
+
+def ingest_file(inputfile, args, grains, outputs_by_grain, manifest,
+                make_lookup, file_metrics, duplicate_indexes=None):
+    """Verifies, parses and writes one input file, unless the Manifest shows
+    it was already written for every requested grain.
+
+    Args:
+        `make_lookup`: A callable returning the IsinLookup to verify with,
+        only called if the file is pending
+        `file_metrics`: The file's FileMetrics, marked 'skipped' if there
+        is nothing to do
+        `duplicate_indexes`: Passed to write_grains()
+    """
+    source_name = os.path.split(inputfile)[-1]
+    plan = plan_inputfiles([inputfile], manifest, outputs_by_grain)
+    if not plan:
+        file_metrics.status = 'skipped'
+        return
+    _, content_hash, pending = plan[0]
+
+    with file_metrics.stage('isin_check'):
+        confirm_valid_isin(inputfile, make_lookup())
+    f_position_date, outfile_rows_by_grain = read_inputfile(
+        inputfile, pending, metrics=file_metrics, **read_options(args))
+    written = []
+    try:
+        write_grains(outfile_rows_by_grain, args.outputfile, source_name,
+                     f_position_date, duplicate_indexes, args.output_format,
+                     len(grains) > 1, file_metrics, written)
+    finally:
+        if manifest is not None and written:
+            manifest.record(source_name, content_hash, f_position_date,
+                            {grain: outputs_by_grain[grain]
+                             for grain in written},
+                            grain_artifacts(args, written, len(grains) > 1,
+                                            source_name, f_position_date))
+
+
+def run_single(args, grains):
+    """Verifies, parses and writes a single --inputfile."""
+    confirm_file_exists(args.inputfile)
+    outputs_by_grain = grain_outputs(args, grains)
+    manifest = open_manifest(args)
+    metrics = open_metrics(args)
+    file_metrics = FileMetrics(os.path.split(args.inputfile)[-1])
+    lookups = []
+
+    def make_lookup():
+        lookups.append(make_isin_lookup(args))
+        return lookups[-1]
+
+    try:
+        ingest_file(args.inputfile, args, grains, outputs_by_grain, manifest,
+                    make_lookup, file_metrics)
+    except SystemExit:
+        file_metrics.status = 'failed'
+        raise
+    finally:
+        for lookup in lookups:
+            lookup.close()
+        if manifest is not None:
+            manifest.close()
+        metrics.add(file_metrics)
+        metrics.close()
+
+
+def run_watch(args, grains):
+    """Runs as a service that parses FDF files as they land in the --watch
+    directory, until interrupted with SIGINT or SIGTERM.
+
+    Files are processed one at a time in this process, so there is no
+    interpreter startup per file. The Manifest, the IsinLookup and its
+    cache, and the DuplicateIndex of every output stay open between files.
+    A file that fails is logged and retried only once it changes. With
+    --status-port, a StatusServer reports progress, and the Prometheus file
+    is rewritten after every file.
+    """
+    import signal
+    import threading
+
+    directory = args.watch
+    if not os.path.isdir(directory):
+        bailout('watch directory: {} does not exist'.format(directory))
+    outputs_by_grain = grain_outputs(args, grains)
+    manifest = open_manifest(args)
+    metrics = open_metrics(args)
+    lookup = make_isin_lookup(args)
+    duplicate_indexes = {}
+    watcher = DropWatcher(directory)
+    # Guards `metrics` and `last`, which the StatusServer thread reads
+    lock = threading.Lock()
+    started = time()
+    last = {}
+
+    def status():
+        with lock:
+            return {'directory': os.path.abspath(directory),
+                    'started': started,
+                    'uptime_seconds': round(time() - started, 3),
+                    'last_file': dict(last),
+                    'run': metrics.summary()}
+
+    def prometheus():
+        with lock:
+            return metrics.prometheus(metrics.summary())
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    server = None
+    try:
+        if args.status_port:
+            server = StatusServer(args.status_port, status, prometheus)
+        logging.warning('watching {} for FDF files'.format(directory))
+        while not stop.is_set():
+            for inputfile in watcher.poll():
+                file_metrics = FileMetrics(os.path.split(inputfile)[-1])
+                try:
+                    ingest_file(inputfile, args, grains, outputs_by_grain,
+                                manifest, lambda: lookup, file_metrics,
+                                duplicate_indexes)
+                except SystemExit:
+                    # Already logged by bailout()
+                    file_metrics.status = 'failed'
+                watcher.done(inputfile)
+                with lock:
+                    metrics.add(file_metrics)
+                    last.update(source_name=file_metrics.source_name,
+                                status=file_metrics.status,
+                                finished=time())
+                    metrics.write_prometheus(metrics.summary())
+                if stop.is_set():
+                    break
+            stop.wait(args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.warning('stopped watching {}'.format(directory))
+        if server is not None:
+            server.close()
+        lookup.close()
+        for index in duplicate_indexes.values():
+            index.close()
+        if manifest is not None:
+            manifest.close()
+        metrics.close()
+
+
+def import_time_ms():
+    """Returns the milliseconds a fresh interpreter spends importing this
+    module, everything it imports included, as reported by
+    `python -X importtime`. None if that cannot be measured."""
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    result = run([sys.executable, '-X', 'importtime', '-c',
+                  'import ' + module],
+                 stdout=PIPE, stderr=PIPE, universal_newlines=True,
+                 cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000
+    return None
+
+
+def report_startup(setup_start, setup_end):
+    """Writes the --profile-startup report to stderr. Import time is
+    measured in a separate interpreter, see import_time_ms(); time spent
+    starting the interpreter itself is not included."""
+    import_ms = import_time_ms()
+    sys.stderr.write('startup: imports {} ms, setup {:.1f} ms'
+                     ' (argument parsing and logging), heavy modules'
+                     ' loaded: {}\n'
+                     .format('n/a' if import_ms is None
+                             else '{:.1f}'.format(import_ms),
+                             (setup_end - setup_start) * 1000,
+                             [name for name in ('numpy', 'pyarrow',
+                                                'multiprocessing')
+                              if name in sys.modules]))
+
+
+def main(argv=None):
+    """Handles the actual logic of the script. `argv` defaults to
+    sys.argv[1:]."""
+    setup_start = perf_counter()
+    args = parse_args(argv)
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG,
+                            format=LOG_FORMAT, datefmt=LOG_DATEFMT)
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO,
+                            format=LOG_FORMAT, datefmt=LOG_DATEFMT)
+    else:
+        logging.basicConfig(level=logging.WARNING,
+                            format=LOG_FORMAT, datefmt=LOG_DATEFMT)
+    if args.profile_startup:
+        report_startup(setup_start, perf_counter())
+
+    grains = resolve_grains(args.grain)
+    if len(grains) > 1 and not os.path.isdir(args.outputfile):
+        bailout('outputfile: {} must be a directory when requesting'
+                ' multiple grains'.format(args.outputfile))
+    if args.output_format != 'ff' and not os.path.isdir(args.outputfile):
+        bailout('outputfile: {} must be a directory for --output-format {}'
+                .format(args.outputfile, args.output_format))
+    if args.writer == 'sharded' and (not args.batch
+                                     or args.output_format != 'ff'):
+        bailout('--writer sharded requires --batch and --output-format ff')
+
+    if args.batch:
+        run_batch(args, grains)
+    elif args.watch:
+        run_watch(args, grains)
+    else:
+        run_single(args, grains)
+    logging.info('--- SUCCESS --- total elapsed time: {} seconds'
+                 .format(time() - START))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,52 @@
+import bench_ishares_eqy_fdf_parse as b
+
+
+def test_compare():
+    baseline = {'a': {'files_per_second': 10, 'peak_rss_kb': 100},
+                'b': {'files_per_second': 10, 'peak_rss_kb': 100,
+                      'children_peak_rss_kb': 100},
+                'd': {'files_per_second': 10, 'peak_rss_kb': 100,
+                      'workers': 1},
+                'e': {'files_per_second': 10, 'peak_rss_kb': 100,
+                      'failed_files': 0}}
+    results = {'a': {'files_per_second': 9, 'peak_rss_kb': 110},
+               'b': {'files_per_second': 5, 'peak_rss_kb': 200,
+                     'children_peak_rss_kb': 300},
+               'c': {'files_per_second': 1, 'peak_rss_kb': 999},
+               'd': {'files_per_second': 1, 'peak_rss_kb': 999,
+                     'workers': 2},
+               'e': {'files_per_second': 1, 'peak_rss_kb': 999,
+                     'failed_files': 3}}
+    assert b.compare(results, baseline, 0.2) == [
+        'b: 5 files/s vs baseline 10 files/s',
+        'b: 200 KB peak RSS vs baseline 100 KB',
+        'b: 300 KB worker peak RSS vs baseline 100 KB']
+
+
+def test_run_stage_process():
+    args = b.parse_args(['-r', '1', '-c', b.CORPUS.replace('2019012*',
+                                                           '20190124')])
+    result = b.run_stage_process('format_header', args)
+    assert result['workers'] == 1
+    assert result['children_peak_rss_kb'] == 0
+    assert result['peak_rss_kb'] > 0
+
+
+def test_main_function(tmp_path):
+    corpus = b.load_corpus(b.CORPUS.replace('2019012*', '20190124'))
+    function, files, rows, replays = b.main_function(corpus, 'fx', 1,
+                                                     str(tmp_path))
+    assert files == len(corpus)
+    function()
+    # Every file is written to an output of its own, so none fails on FX
+    # rates it shares with another fund
+    assert b.failed_files(replays[-1]) == 0
+
+
+def test_load_corpus(tmp_path):
+    fdf = tmp_path / 'XFDF.csv'
+    # The last section of a file is not always terminated
+    fdf.write_text('﻿Fund Level\nFund Name,X\n\nSwaps\nA,B')
+    corpus = b.load_corpus(str(tmp_path / '*FDF.*'))
+    assert corpus == [(str(fdf), ['Fund Level', 'Fund Name,X', '', 'Swaps',
+                                  'A,B'], {'Fund Level', 'Swaps'})]
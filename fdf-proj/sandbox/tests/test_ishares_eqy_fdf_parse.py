@@ -1,3 +1,10 @@
+import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+
 import pytest
 import ishares_eqy_fdf_parse as s
 
@@ -9,6 +16,20 @@ def test_parse_data():
     assert s.parse_data(data, start, end) == ['A1', 'A2']
 
 
+def test_import_skips_pandas():
+    # pandas is only imported by the code paths that need it
+    result = subprocess.run(
+        [sys.executable, '-c', 'import sys, ishares_eqy_fdf_parse;'
+         ' print("pandas" in sys.modules)'],
+        cwd=os.path.dirname(os.path.abspath(s.__file__)),
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    assert result.stdout.strip() == 'False'
+
+
+def test_import_time_ms():
+    assert s.import_time_ms() > 0
+
+
 def test_transpose():
     data = ['Fund Ticker,IOGP', 'Fund ISIN,IE00B6R51Z18']
     assert s.transpose(data) == ['Fund Ticker|Fund ISIN', 'IOGP|IE00B6R51Z18']
@@ -29,3 +50,505 @@ def test_merge_holdings():
     data = [['A,B,C', '1,2,3', 'REMOVE ME,,'], ['B,C,D', '4,5,6']]
     data_merged = ['a|b|c|d', '1|2|3|', '|4|5|6']
     assert s.merge_holdings(data) == data_merged
+
+
+def test_section_index():
+    data = ['A Lvl', 'A1', 'B Lvl', 'B1', '', 'C Lvl', 'A1', 'C1', '', 'D']
+    index = s.SectionIndex(data)
+    for start in ['A Lvl', 'A1', 'B Lvl', 'C Lvl', 'C1', '']:
+        assert index.parse_data(start, '') == s.parse_data(data, start, '')
+    assert index.parse_data('A Lvl', 'B1') == ['A1', 'B Lvl']
+    for start in ['D', 'E']:
+        with pytest.raises(SystemExit):
+            index.parse_data(start, '')
+
+
+def test_confirm_valid_date():
+    data = ['Fund Level', 'Fund Ticker,EWJ', 'Fund Size,1.5,Jan 22 2019',
+            'Shares Outstanding,2,Jan 22 2019', '']
+    assert s.confirm_valid_date(data) == '2019-01-22'
+    assert s.confirm_valid_date(s.SectionIndex(data)) == '2019-01-22'
+    data[3] = 'Shares Outstanding,2,Jan 23 2019'
+    with pytest.raises(SystemExit):
+        s.confirm_valid_date(data)
+
+
+def test_resolve_grains():
+    assert s.resolve_grains('all') == list(s.GRAINS.keys())
+    assert s.resolve_grains('fund, fx') == ['fund', 'fx']
+    with pytest.raises(SystemExit):
+        s.resolve_grains('fund,bogus')
+
+
+def test_find_inputfiles(tmp_path):
+    for name in ['B_PCF_us_20190122FDF.csv', 'CPCFA240119FDF.CSV',
+                 'CPCFA240119A.csv']:
+        (tmp_path / name).write_text('')
+    assert s.find_inputfiles(str(tmp_path)) == [
+        str(tmp_path / 'B_PCF_us_20190122FDF.csv'),
+        str(tmp_path / 'CPCFA240119FDF.CSV')]
+    assert s.find_inputfiles(str(tmp_path / '*A.csv')) == [
+        str(tmp_path / 'CPCFA240119A.csv')]
+
+
+def test_iter_sections():
+    data = 'A Lvl\nA1\nA2\n\nB Lvl\nB1\r\n\nC Lvl\nC1\n'
+    assert list(s.iter_sections(io.StringIO(data), {'A Lvl', 'B Lvl'})) == [
+        ('A Lvl', ['A1', 'A2']), ('B Lvl', ['B1\r'])]
+    with pytest.raises(SystemExit):
+        list(s.iter_sections(io.StringIO(data.rstrip('\n'))))
+
+    # As with parse_data(), a final line ending ends the last section, and
+    # a section header needs no empty line before it
+    data = 'A Lvl\nA1\nB Lvl\nB1\n\nC Lvl\nC1\n'
+    names = ['A Lvl', 'B Lvl', 'C Lvl']
+    assert dict(s.iter_sections(io.StringIO(data), names)) == {
+        name: s.parse_data(data.split('\n'), name, '') for name in names}
+
+
+def test_read_sections_mmap(tmp_path):
+    inputfile = tmp_path / 'XFDF.csv'
+    inputfile.write_bytes('\ufeffA Lvl\r\nA1\r\nA2\r\n  \r\nB Lvl\nB1\n\n'
+                          'A Lvl\nA3\nD Lvl\nD1\n\nC Lvl\nC1\n'
+                          .encode('utf-8'))
+    for names in ({'A Lvl'}, {'A Lvl', 'B Lvl'}, {'C Lvl', 'D Lvl'}, None):
+        assert list(s.read_sections(str(inputfile), names, 'mmap')) == (
+            list(s.read_sections(str(inputfile), names)))
+    assert list(s.read_sections(str(inputfile), {'D Lvl', 'C Lvl'},
+                                'mmap')) == [('D Lvl', ['D1']),
+                                             ('C Lvl', ['C1'])]
+    inputfile.write_bytes(b'A Lvl\nA1\n\nC Lvl\nC1')
+    with pytest.raises(SystemExit):
+        list(s.read_sections(str(inputfile), {'C Lvl'}, 'mmap'))
+
+
+def test_duplicate_index(tmp_path):
+    outputfile = str(tmp_path / 'isharesfdfeqy_fx.ff')
+    with open(outputfile, 'w') as outfile:
+        outfile.write('source_category|source_name|f_position_date|a|b\n'
+                      'iShares FTP|X.csv|2019-01-22|1|2\n')
+    rows = ['a|b', '3|4', '1|2']
+    assert s.confirm_headers_match(rows, outputfile)
+    with pytest.raises(SystemExit):
+        s.confirm_no_duplicates(rows, outputfile)
+
+    s.write_grains({'fx': rows[:2]}, outputfile, 'Y.csv', '2019-01-23')
+    index = s.DuplicateIndex(outputfile)
+    assert index.overlap(['1|2', '3|4', '5|6']) == {'1|2', '3|4'}
+    index.close()
+
+    # Edits made outside of the parser invalidate the index
+    with open(outputfile, 'a') as outfile:
+        outfile.write('iShares FTP|Z.csv|2019-01-24|5|6\n')
+    with pytest.raises(SystemExit):
+        s.confirm_no_duplicates(['a|b', '5|6'], outputfile)
+
+    # An index kept open, as by --watch, notices the output being rotated
+    duplicate_indexes = {}
+    s.write_grains({'fx': ['a|b', '7|8']}, outputfile, 'W.csv',
+                   '2019-01-25', duplicate_indexes)
+    with open(outputfile, 'w') as outfile:
+        outfile.write('source_category|source_name|f_position_date|a|b\n')
+    s.write_grains({'fx': ['a|b', '7|8']}, outputfile, 'W.csv',
+                   '2019-01-25', duplicate_indexes)
+    duplicate_indexes[outputfile].close()
+
+
+def test_duplicate_index_torn_append(tmp_path):
+    outputfile = str(tmp_path / 'isharesfdfeqy_fx.ff')
+    s.write_grains({'fx': ['a|b', '1|2']}, outputfile, 'X.csv', '2019-01-22')
+    written = open(outputfile).read()
+    # An append killed before its first row was complete
+    with open(outputfile, 'a') as outfile:
+        outfile.write('iShares FTP|Y.csv|2019-01-23|3')
+    s.write_grains({'fx': ['a|b', '5|6']}, outputfile, 'Z.csv', '2019-01-24')
+    with open(outputfile) as outfile:
+        assert outfile.read() == written + 'iShares FTP|Z.csv|2019-01-24|5|6\n'
+
+    # Without a usable recorded size, the partial row is still dropped
+    os.remove(outputfile + s.DUPLICATE_INDEX_SUFFIX)
+    with open(outputfile, 'a') as outfile:
+        outfile.write('iShares FTP|Y.csv|2019-01-23|3')
+    index = s.DuplicateIndex(outputfile)
+    assert index.overlap(['1|2', '3', '5|6']) == {'1|2', '5|6'}
+    index.close()
+    with open(outputfile) as outfile:
+        assert outfile.read().endswith('|5|6\n')
+
+
+def test_write_grains_per_grain(tmp_path):
+    rows = {'fund': ['a|b', '1|2'], 'fx': ['c|d', '3|4']}
+    assert s.write_grains(rows, str(tmp_path), 'X.csv',
+                          '2019-01-22') == ['fund', 'fx']
+
+    # A duplicate fx row does not hold back the fund grain
+    rows = {'fund': ['a|b', '5|6'], 'fx': ['c|d', '3|4']}
+    written = []
+    with pytest.raises(SystemExit):
+        s.write_grains(rows, str(tmp_path), 'Y.csv', '2019-01-23',
+                       written=written)
+    assert written == ['fund']
+    with open(str(tmp_path / 'isharesfdfeqy_fund.ff')) as outfile:
+        assert outfile.read().splitlines()[-1] == (
+            'iShares FTP|Y.csv|2019-01-23|5|6')
+
+
+def test_isin_lookup(tmp_path):
+    queries = []
+
+    def backend(sql):
+        queries.append(sql)
+        if 'markit_issue_name in' in sql:
+            return [['iShares MSCI Japan ETF', 'US46434G8226']]
+        return [['IOGP', 'IE00B6R51Z18']]
+
+    cache_path = str(tmp_path / 'isin.db')
+    funds = [('iShares MSCI Japan ETF', 'EWJ'), ("Fund's Name", 'IOGP'),
+             ('Unknown Fund', 'UNKNOWN')]
+    lookup = s.IsinLookup(backend, cache_path)
+    assert lookup.resolve(funds) == {
+        funds[0]: 'US46434G8226', funds[1]: 'IE00B6R51Z18', funds[2]: None}
+    assert len(queries) == 2
+    assert "'Fund''s Name'" in queries[0]
+    lookup.close()
+
+    lookup = s.IsinLookup(backend, cache_path)
+    assert lookup.resolve(funds[:2])[funds[1]] == 'IE00B6R51Z18'
+    assert len(queries) == 2
+    lookup.close()
+
+    lookup = s.IsinLookup(backend, cache_path, ttl=-1)
+    lookup.resolve(funds[:1])
+    assert len(queries) == 3
+    lookup.close()
+
+
+FAKE_QUERY = """#!{}
+# Stand-in for `query aeon <sql> kettle blk-w`: a header line, then one
+# whitespace-aligned row per match. Every quoted key of the first
+# `in (...)` list resolves, except those starting with Unknown
+import re
+import sys
+keys = re.search(r" in \\((.*?)\\)\\s+and", sys.argv[2]).group(1)
+with open(sys.argv[0] + '.log', 'a') as log:
+    log.write(sys.argv[2] + '\\n')
+print('{{:<20}} isin'.format(re.search(r"select (\\w+)",
+                                       sys.argv[2]).group(1)))
+for key in re.findall(r"'((?:[^']|'')*)'", keys):
+    if not key.startswith('Unknown'):
+        print('{{:<20}} XX{{}}'.format(key.replace("''", "'"), len(key)))
+"""
+
+
+def test_isin_verifier(tmp_path):
+    query = tmp_path / 'query'
+    query.write_text(FAKE_QUERY.format(sys.executable))
+    query.chmod(0o755)
+    inputfiles = []
+    for name, ticker in [('Fund A', 'A'), ('Fund A', 'A'), ('Fund B', 'B'),
+                         ('Unknown C', 'UnknownC'), ('Unknown D', 'D')]:
+        inputfile = tmp_path / '{}{}FDF.csv'.format(ticker, len(inputfiles))
+        inputfile.write_text('Fund Level\nFund Name,{}\nFund Ticker,{}\n'
+                             .format(name, ticker))
+        inputfiles.append(str(inputfile))
+
+    verifier = s.IsinVerifier(
+        inputfiles,
+        lambda: s.IsinLookup(s.AeonQueryBackend(str(query)), ':memory:'),
+        concurrency=2, chunk_size=1)
+    assert [verifier.verified(inputfile) for inputfile in inputfiles] == [
+        True, True, True, False, True]
+    verifier.close()
+    queries = (tmp_path / 'query.log').read_text().splitlines()
+    # One name query per distinct fund, then tickers of the two unknowns
+    assert len(queries) == 6
+
+
+def test_parse_query_rows():
+    stdout = ('markit_issue_name                   isin\n'
+              'iShares Core MSCI Japan IMI UCITS   IE00B4L5YX21\n'
+              'EWJ\tUS46434G8226\n\n')
+    assert s.parse_query_rows(stdout) == [
+        ['iShares Core MSCI Japan IMI UCITS', 'IE00B4L5YX21'],
+        ['EWJ', 'US46434G8226']]
+    assert s.parse_query_rows('dixie_ticker|isin\nA|B C|XX1\n', '|') == [
+        ['A|B C', 'XX1']]
+    # A header alone means no matches
+    assert s.parse_query_rows('isin\n') == []
+    # Output that no row can be read from is an error, not "no matches",
+    # e.g. the bare ISINs of a single column select
+    with pytest.raises(SystemExit):
+        s.parse_query_rows('isin\nIE00B4L5YX21\n')
+    with pytest.raises(SystemExit):
+        s.parse_query_rows('isin\nFund A XX6\n', '|')
+
+
+def test_format_date_rejects_non_dates():
+    data = ['Jan 24 2019|Feb 30 2019|Foo 1 2019|12 2019|jan  4 2019',
+            'IOGP|100.00|']
+    assert s.format_date(data) == [
+        '2019-01-24|Feb 30 2019|Foo 1 2019|12 2019|2019-01-04',
+        'IOGP|100.00|']
+
+
+def test_merge_holdings_padding():
+    data = [['A, B,C', '1,2,3', '4', 'REMOVE ME,,'], ['C,D,A', '5,6,7']]
+    assert s.merge_holdings(data) == ['a|b|c|d', '1|2|3|', '4|||', '7||5|6']
+    with pytest.raises(SystemExit):
+        s.merge_holdings([['A', '1,2', 'REMOVE ME'], ['A']])
+
+
+def test_typed_value():
+    assert s.typed_value('fund_size', '15632440260.80') == 15632440260.8
+    assert s.typed_value('fund_size', '') is None
+    assert str(s.typed_value('value_date', '20190205')) == '2019-02-05'
+    assert str(s.typed_value('trade_date', '2019-01-23')) == '2019-01-23'
+    assert s.typed_value('total_expense_ratio', '0.55%') == '0.55%'
+
+
+def test_write_columnar(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    rows = ['currency,spot_rate', 'JPY,0.009137', 'KRW,']
+    s.write_grains({'fx': rows}, str(tmp_path), 'EWJ.csv', '2019-01-22',
+                   output_format='parquet')
+    part = s.columnar_part(str(tmp_path), 'fx', '2019-01-22', 'EWJ.csv',
+                           'parquet')
+    assert pq.read_table(part).to_pydict() == {
+        'source_category': ['iShares FTP', 'iShares FTP'],
+        'source_name': ['EWJ.csv', 'EWJ.csv'],
+        'currency': ['JPY', 'KRW'],
+        'spot_rate': [0.009137, None]}
+    with pytest.raises(SystemExit):
+        s.write_grains({'fx': rows}, str(tmp_path), 'EWJ.csv', '2019-01-22',
+                       output_format='parquet')
+
+
+def test_write_grain(tmp_path):
+    outputfile = str(tmp_path / 'isharesfdfeqy_fund.ff')
+    assert s.format_body(['a|b'], 'X.csv', '2019-01-22') == ''
+    s.write_grain(['a|b', '1|2'], outputfile, 'X.csv', '2019-01-22', False)
+    s.write_grain(['a|b', '3|4'], outputfile, 'Y.csv', '2019-01-23', True)
+    with open(outputfile) as outfile:
+        assert outfile.read() == (
+            'source_category|source_name|f_position_date|a|b\n'
+            'iShares FTP|X.csv|2019-01-22|1|2\n'
+            'iShares FTP|Y.csv|2019-01-23|3|4\n')
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'isharesfdfeqy_fund.ff']
+
+
+def test_part_merger(tmp_path):
+    outputfile = str(tmp_path / 'isharesfdfeqy_fund.ff')
+    merger = s.PartMerger(outputfile, False)
+    parts = {}
+    for source_name, rows, date in [('X.csv', ['a|b', '1|2'], '2019-01-22'),
+                                    ('Y.csv', ['a|b', '3|4'], '2019-01-23'),
+                                    ('Z.csv', ['a|b', '1|2'], '2019-01-24')]:
+        parts[source_name] = s.part_path(outputfile, 'fund', False,
+                                         source_name)
+        s.write_part(rows, parts[source_name], source_name, date)
+    metrics = s.FileMetrics('X.csv')
+    merger.merge({'fund': parts['X.csv']}, metrics)
+    merger.merge({'fund': parts['Y.csv']}, metrics)
+    with pytest.raises(SystemExit):
+        merger.merge({'fund': parts['Z.csv']}, metrics)
+    merger.close()
+    with open(outputfile) as outfile:
+        assert outfile.read() == (
+            'source_category|source_name|f_position_date|a|b\n'
+            'iShares FTP|X.csv|2019-01-22|1|2\n'
+            'iShares FTP|Y.csv|2019-01-23|3|4\n')
+    assert set(metrics.stages) == {'duplicate_check', 'merge'}
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'isharesfdfeqy_fund.ff', 'isharesfdfeqy_fund.ff.idx']
+
+
+def test_manifest(tmp_path):
+    inputfile = tmp_path / 'EWJ_PCF_us_20190122FDF.csv'
+    inputfile.write_text('Fund Level\n')
+    outputs = {'fund': str(tmp_path / 'isharesfdfeqy_fund.ff'),
+               'fx': str(tmp_path / 'isharesfdfeqy_fx.ff')}
+    for output in outputs.values():
+        with open(output, 'w') as outfile:
+            outfile.write('header\nrow\n')
+    manifest = s.Manifest(str(tmp_path / 'manifest.db'))
+    content_hash = s.file_digest(str(inputfile))
+    assert s.plan_inputfiles([str(inputfile)], manifest, outputs) == [
+        (str(inputfile), content_hash, ['fund', 'fx'])]
+
+    manifest.record(inputfile.name, content_hash, '2019-01-22',
+                    {'fund': outputs['fund']})
+    assert s.plan_inputfiles([str(inputfile)], manifest, outputs) == [
+        (str(inputfile), content_hash, ['fx'])]
+    manifest.record(inputfile.name, content_hash, '2019-01-22',
+                    {'fx': outputs['fx']})
+    assert s.plan_inputfiles([str(inputfile)], manifest, outputs) == []
+
+    # Later appends keep the entries, losing rows does not
+    with open(outputs['fund'], 'a') as outfile:
+        outfile.write('more\n')
+    assert s.plan_inputfiles([str(inputfile)], manifest, outputs) == []
+    with open(outputs['fund'], 'r+') as outfile:
+        outfile.truncate(7)
+    os.replace(outputs['fund'], outputs['fx'])
+    assert s.plan_inputfiles([str(inputfile)], manifest, outputs)[0][2] == [
+        'fund', 'fx']
+
+    inputfile.write_text('Fund Level\nFund Ticker,EWJ\n')
+    assert s.plan_inputfiles([str(inputfile)], manifest, outputs)[0][2] == [
+        'fund', 'fx']
+    manifest.close()
+
+
+def test_manifest_rerun_after_delete(tmp_path, monkeypatch):
+    inputfile = tmp_path / 'EWJ_PCF_us_20190122FDF.csv'
+    inputfile.write_text('Fund Level\nFund Name,Fund A\n'
+                         'Fund Ticker,EWJ\nAs Of Date,Jan 22 2019\n'
+                         'Fund Size,100.5,Jan 22 2019\n\n')
+    outputfile = tmp_path / 'isharesfdfeqy_fund.ff'
+    monkeypatch.setattr(s, 'TARGET_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(s, 'confirm_valid_isin', lambda *args: 0)
+    argv = ['-i', str(inputfile), '-o', str(outputfile), '-g', 'fund']
+    s.main(argv)
+    written = outputfile.read_text()
+    # Unchanged input and output: skipped
+    s.main(argv)
+    assert outputfile.read_text() == written
+
+    outputfile.unlink()
+    s.main(argv)
+    assert outputfile.read_text() == written
+
+
+def test_metrics(tmp_path):
+    inputfile = tmp_path / 'EWJ_PCF_us_20190122FDF.csv'
+    inputfile.write_text('Fund Level\nFund Name,X\nDate,,Jan 22 2019\n\n'
+                         'FX Rates\nCurrency,Rate\nJPY,0.009\n\n')
+    metrics = s.FileMetrics(inputfile.name)
+    s.read_inputfile(str(inputfile), ['fx'], metrics=metrics)
+    assert metrics.f_position_date == '2019-01-22'
+    assert metrics.rows == {'fx': {'in': 2, 'out': 1}}
+    assert set(metrics.stages) == {'read', 'date_validation', 'transform'}
+
+    writer = s.MetricsWriter(str(tmp_path / 'metrics.jsonl'),
+                             str(tmp_path / 'fdf.prom'))
+    writer.add(metrics)
+    writer.close()
+    records = [json.loads(line)
+               for line in (tmp_path / 'metrics.jsonl').read_text()
+               .splitlines()]
+    assert [record['record'] for record in records] == ['file', 'run']
+    assert records[1]['files'] == {'ok': 1}
+    assert records[1]['rows'] == {'fx': {'in': 2, 'out': 1}}
+    prom = (tmp_path / 'fdf.prom').read_text()
+    assert 'isharesfdfeqy_rows{grain="fx",direction="in"} 2\n' in prom
+    assert 'isharesfdfeqy_files{status="ok"} 1\n' in prom
+
+
+def test_drop_watcher(tmp_path):
+    watcher = s.DropWatcher(str(tmp_path))
+    inputfile = tmp_path / 'EWJ_PCF_us_20190122FDF.csv'
+    inputfile.write_text('Fund Level\n')
+    (tmp_path / 'notes.txt').write_text('x')
+    assert watcher.poll() == []
+    assert watcher.poll() == [str(inputfile)]
+    watcher.done(str(inputfile))
+    assert watcher.poll() == []
+    inputfile.write_text('Fund Level\nFund Name,X\n')
+    assert watcher.poll() == []
+    assert watcher.poll() == [str(inputfile)]
+
+
+def test_status_server():
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+    server = s.StatusServer(0, lambda: {'files': 1}, lambda: 'up 1\n')
+    url = 'http://127.0.0.1:{}/'.format(server.port)
+    try:
+        assert json.loads(urlopen(url + 'status').read()) == {'files': 1}
+        assert urlopen(url + 'metrics').read() == b'up 1\n'
+        with pytest.raises(HTTPError):
+            urlopen(url + 'other')
+    finally:
+        server.close()
+
+
+def test_grain_records():
+    sections = {'Fund Level': ['Fund Name,"iShares, Inc."',
+                               'As Of,,Jan 22 2019', 'Fund Size,1.5']}
+    records = s.grain_records(sections, 'fund')
+    assert records[0].columns.names == ['fund_name', 'as_of', 'as_of_date',
+                                        'fund_size']
+    assert records[0]['fund_name'] == 'iShares, Inc.'
+    assert records[0].typed()['as_of_date'] == datetime.date(2019, 1, 22)
+    assert records[0].typed()['fund_size'] == 1.5
+
+
+def original_grain(sections, grain):
+    """The rows the original transpose()/format_header() chain builds."""
+    if grain == 'holdings':
+        return s.merge_holdings([sections[name]
+                                 for name in s.GRAINS[grain]])
+    section = sections[s.GRAINS[grain]]
+    if grain == 'fx':
+        return ['currency,spot_rate'] + section[1:]
+    if grain == 'forwards':
+        return s.format_header(section)
+    if grain in ['spreads', 'allocations']:
+        return [row.replace(',', '|') for row in s.format_header(section)]
+    return s.format_header(s.format_date(s.transpose(section)))
+
+
+def test_extract_grain_matches_original():
+    sections = {
+        'Fund Level': ['Fund Ticker,IOGP', 'As Of,,Jan 22 2019'],
+        'Basket Level': ['Trade Date,Jan 23 2019', 'Settlement Date'],
+        'Swaps': ['Swap Notional,'],
+        'Spreads': ['Type,Bid Spread, Threshold', 'A,1,2'],
+        'Allocation Details': ['Allocation Type,Allocation Weight'],
+        'Holdings: Securities': ['A, B,,', '1,2,,', '3,4', 'TOTAL,6,,'],
+        'Holdings: Synthetics': ['B,C', '5,6'],
+        'FX Rates': ['Base Currency,USD', 'JPY,0.009137'],
+        'FX Forwards': ['Currency Pair,Value Date', 'USD/JPY,20190124']}
+    for grain in s.GRAINS:
+        assert s.extract_grain(sections, grain) == (
+            original_grain(sections, grain)), grain
+
+
+def test_read_inputfile_quoted_fund_name(tmp_path):
+    inputfile = tmp_path / 'CPCFIOGP220119FDF.csv'
+    inputfile.write_text('Fund Level\n'
+                         'Fund Name,"iShares, Inc. Fund"\n'
+                         'Fund Ticker,IOGP\n'
+                         'Total NAV per share,53.58,Jan 22 2019\n'
+                         'Fund Size,100.5,Jan 22 2019\n'
+                         '\n')
+    assert s.read_fund_identity(str(inputfile)) == ('iShares, Inc. Fund',
+                                                    'IOGP')
+    f_position_date, outfile_rows_by_grain = s.read_inputfile(
+        str(inputfile), ['fund'])
+    assert f_position_date == '2019-01-22'
+    assert outfile_rows_by_grain['fund'] == [
+        'fund_name|fund_ticker|total_nav_per_share|total_nav_per_share_date'
+        '|fund_size|fund_size_date',
+        'iShares, Inc. Fund|IOGP|53.58|2019-01-22|100.5|2019-01-22']
+
+
+def test_reconcile_holdings():
+    pytest.importorskip('numpy')
+    header = ('Name,Deliverable Basket Qty,Pricing Basket Qty,'
+              'Excluded Basket Qty,Price(in Fund Base Currency)')
+    sections = {
+        'Fund Level': ['Total NAV per Share,10.0'],
+        'Basket Level': ['Shares per Basket (PNU),100',
+                         'Projected Cash for Pricing Basket,5'],
+        'Holdings: Securities': [header, 'A,10,10,,50', 'B,20,19,1,26',
+                                 ',30,29,1']}
+    assert s.reconcile_holdings(sections) == []
+    sections['Holdings: Securities'][-1] = ',30,28,1'
+    sections['Basket Level'][1] = 'Projected Cash for Pricing Basket,50'
+    mismatches = s.reconcile_holdings(sections)
+    assert len(mismatches) == 2
+    assert mismatches[0].startswith('pricing_basket_qty sums to 29.00000')
+    assert mismatches[1].startswith('pricing basket of 994.00 plus cash')
+    assert s.reconcile_holdings({}) == ['section Fund Level not found']
@@ -3,8 +3,19 @@ Testing Suite for upcat.py
 """
 
 
+import io
+import os
+import shutil
+import tempfile
 import unittest
 
+from contextlib import redirect_stdout
+
+import upcat
+
+
+CATALOG_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
 
 class TestMethods(unittest.TestCase):
     """Collection of tests for upcat.py"""
@@ -14,6 +25,195 @@ class TestMethods(unittest.TestCase):
     # assertFalse()
     # assertRaises()
 
+    def setUp(self):
+        # upcat expects catalog files in the working directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        for file in upcat.PRIMARY_KEY_FILES + upcat.COMPOSITE_KEY_FILES:
+            shutil.copy(os.path.join(CATALOG_DIRECTORY, file), self.directory)
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_catalog_index(self):
+        index = upcat.CatalogIndex("Labs.catalog.test")
+        self.assertEqual(index.header,
+                         ["NAME", "SERVER", "CENTER", "ACTIVE", "DOMINANCE"])
+        self.assertEqual(index.columns["dominance"], 4)
+        self.assertEqual(list(index.rows), ["lab", "lab-w", "lab-e"])
+        self.assertTrue("lab-w" in index)
+        self.assertFalse("lab-x" in index)
+        self.assertEqual(index.fields("lab-e"),
+                         ["lab-e", "blkbraa009", "hal", "n", "1"])
+        offset = index.rows["lab-w"]
+        self.assertEqual(index.data[offset:offset + 25],
+                         b"lab-w|blkcraa009|ewd|n|2\n")
+        self.assertEqual(index.suggestions("lab-"), ["lab-w", "lab-e"])
+        self.assertEqual(index.splice("lab-w", b"lab-w|x|ewd|y|2\n"),
+                         b"NAME|SERVER|CENTER|ACTIVE|DOMINANCE\n"
+                         b"lab|blkcraa020|ewd|n|3\n"
+                         b"lab-w|x|ewd|y|2\n"
+                         b"lab-e|blkbraa009|hal|n|1\n")
+
+    def test_sidecar_index(self):
+        index = upcat.CatalogIndex("Labs.catalog.test")
+        self.assertTrue(os.path.isfile("Labs.catalog.test.idx"))
+        self.assertIsNotNone(upcat.load_sidecar("Labs.catalog.test"))
+
+        # Rows are read by seeking to their offset, not by parsing the file
+        cached = upcat.CatalogIndex("Labs.catalog.test")
+        self.assertIsNone(cached._data)
+        self.assertEqual(cached.rows, index.rows)
+        self.assertEqual(cached.fields("lab-e"),
+                         ["lab-e", "blkbraa009", "hal", "n", "1"])
+        self.assertIsNone(cached._data)
+
+        # Appending a row changes the size, which invalidates the sidecar
+        upcat.main(["add", "Labs.catalog.test", "lab-x"])
+        self.assertIsNone(upcat.load_sidecar("Labs.catalog.test"))
+        self.assertTrue("lab-x" in upcat.CatalogIndex("Labs.catalog.test"))
+        self.assertIsNotNone(upcat.load_sidecar("Labs.catalog.test"))
+
+    def test_update(self):
+        upcat.main(["update", "Products.catalog.test", "etp_mkt_flow",
+                    "TYPE", "mirror", "has_poller", "n"])
+        with open("Products.catalog.test") as infile:
+            original = infile.readlines()
+        with open("Products.catalog.test.out") as outfile:
+            updated = outfile.readlines()
+        self.assertEqual(len(updated), len(original))
+        changed = [line for line in updated if line not in original]
+        self.assertEqual(changed,
+                         ["etp_mkt_flow|mirror|blk|0.001||1|1g|1g|1g||n||\n"])
+
+    def test_add_and_delete(self):
+        upcat.main(["add", "Labs.catalog.test", "lab-x"])
+        self.assertEqual(upcat.CatalogIndex("Labs.catalog.test")
+                         .fields("lab-x"), ["lab-x", "", "", "", ""])
+        with self.assertRaises(SystemExit):
+            upcat.main(["add", "Labs.catalog.test", "lab-x"])
+
+        upcat.input = lambda prompt: "y"
+        try:
+            upcat.main(["delete", "Labs.catalog.test", "lab-w"])
+        finally:
+            del upcat.input
+        self.assertEqual(upcat.get_keys("Labs.catalog.test"),
+                         ["lab", "lab-e", "lab-x"])
+
+    def test_apply(self):
+        with open("changes.jsonl", "w") as outfile:
+            outfile.write(
+                '{"op": "update", "key": "lab", "values": {"ACTIVE": "y"}}\n'
+                '{"op": "add", "key": "lab-x", "values": {"center": "ewd"}}\n'
+                '{"op": "delete", "key": "lab-w"}\n')
+        upcat.main(["apply", "Labs.catalog.test", "changes.jsonl", "-y"])
+        with open("Labs.catalog.test") as infile:
+            self.assertEqual(infile.read(),
+                             "NAME|SERVER|CENTER|ACTIVE|DOMINANCE\n"
+                             "lab|blkcraa020|ewd|y|3\n"
+                             "lab-e|blkbraa009|hal|n|1\n"
+                             "lab-x||ewd||\n")
+
+        # Any invalid change fails the whole file, which is left untouched
+        with open("changes.csv", "w") as outfile:
+            outfile.write("op,key,column,value\n"
+                          "update,lab-e,active,y\n"
+                          "update,lab-w,active,y\n"
+                          "update,lab,typo,y\n")
+        changes = upcat.read_changes("changes.csv")
+        self.assertEqual(changes[0],
+                         (2, "update", "lab-e", None, {"active": "y"}))
+        _, errors = upcat.plan_changes(upcat.CatalogIndex("Labs.catalog.test"),
+                                       changes)
+        self.assertEqual(len(errors), 2)
+        with self.assertRaises(SystemExit):
+            upcat.main(["apply", "Labs.catalog.test", "changes.csv", "-y"])
+        self.assertEqual(upcat.CatalogIndex("Labs.catalog.test")
+                         .fields("lab-e"), ["lab-e", "blkbraa009", "hal", "n",
+                                            "1"])
+
+    def test_composite_key(self):
+        index = upcat.CatalogIndex("Services.catalog.test")
+        self.assertEqual(index.key_length, 2)
+        self.assertTrue(("cayley", "psh-w") in index)
+        self.assertEqual(index.fields(("cayley", "dev-e")),
+                         ["cayley", "dev-e", "y", "aetherdb", "0", "CORE"])
+        # cayley|psh-w is in the file twice
+        self.assertEqual(len(index.duplicates[("cayley", "psh-w")]), 1)
+        lines = [index.line_at(offset).decode()
+                 for offset in index.offsets_by(1, "tst-w")]
+        self.assertEqual(len(lines), 9)
+        self.assertTrue(all(line.split("|")[1] == "tst-w" for line in lines))
+        self.assertEqual(len(index.offsets_by(0, "cayley")), 8)
+
+        upcat.main(["add", "Services.catalog.test", "newsvc", "-e", "tst-w"])
+        with self.assertRaises(SystemExit):
+            upcat.main(["add", "Services.catalog.test", "newsvc"])
+        self.assertEqual(upcat.CatalogIndex("Services.catalog.test")
+                         .fields(("newsvc", "tst-w")),
+                         ["newsvc", "tst-w", "", "", "", ""])
+        self.assertTrue(("newsvc", "tst-w")
+                        in upcat.get_keys("Services.catalog.test"))
+
+    def test_duplicate_keys(self):
+        # sqlexporter|dev-e is in the file twice, with different instances
+        with open("Services.catalog.test") as infile:
+            original = infile.read()
+        self.assertEqual(original.count("sqlexporter|dev-e|"), 2)
+
+        upcat.input = lambda prompt: "y"
+        try:
+            with self.assertRaises(SystemExit):
+                upcat.main(["delete", "Services.catalog.test", "sqlexporter",
+                            "-e", "dev-e"])
+        finally:
+            del upcat.input
+        with self.assertRaises(SystemExit):
+            upcat.main(["update", "Services.catalog.test", "cayley",
+                        "-e", "psh-w", "wave", "METRICS"])
+        self.assertFalse(os.path.exists("Services.catalog.test.out"))
+
+        changes = [(1, "update", "cayley", "psh-w", {"wave": "METRICS"}),
+                   (2, "delete", "sqlexporter", "dev-e", {})]
+        rows, errors = upcat.plan_changes(
+            upcat.CatalogIndex("Services.catalog.test"), changes)
+        self.assertEqual(rows, {})
+        self.assertEqual(len(errors), 2)
+        self.assertIn("sqlexporter|dev-e|y|qlty|1|METRICS", errors[1])
+        with open("Services.catalog.test") as infile:
+            self.assertEqual(infile.read(), original)
+
+    def test_query(self):
+        def query(*argv):
+            output = io.StringIO()
+            with redirect_stdout(output):
+                upcat.main(["query"] + list(argv))
+            return output.getvalue().splitlines()
+
+        rows = query("Products.catalog.test", "TYPE=tsfact", "has_poller=y",
+                     "-c", "name,type")
+        self.assertEqual(rows[0], "NAME|TYPE")
+        self.assertEqual(rows[1], "eqy_mkt_tqa_ds_cax_splt|tsfact")
+        with open("Products.catalog.test") as infile:
+            expected = [line.split("|") for line in infile][1:]
+        expected = [fields[0] + "|tsfact" for fields in expected
+                    if fields[1] == "tsfact" and fields[10] == "y"]
+        self.assertEqual(rows[1:], expected)
+
+        # The inverted indexes built above are saved in the sidecar
+        self.assertEqual(sorted(upcat.load_sidecar("Products.catalog.test")
+                                ["inverted"]), [1, 10])
+
+        counts = query("Services.catalog.test", "environment=tst-w",
+                       "WAVE!=CORE", "-g", "wave")
+        self.assertEqual(counts, ["WAVE|COUNT", "METRICS|4", "WA|1"])
+        self.assertEqual(len(query("Labs.catalog.test")), 4)
+        with self.assertRaises(SystemExit):
+            query("Labs.catalog.test", "typo=x")
+
 
 if __name__ == "__main__":
     unittest.main()
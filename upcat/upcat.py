@@ -6,9 +6,16 @@ Author: Anthony Chao (achao)
 """
 
 
+import os
 import sys
+import csv
+import json
+import pickle
+import shutil
 import argparse
 
+from collections import Counter
+
 
 PRIMARY_KEY_FILES = ["Centers.catalog.test",
                      "Environments.catalog.test",
@@ -17,226 +24,683 @@ PRIMARY_KEY_FILES = ["Centers.catalog.test",
 
 COMPOSITE_KEY_FILES = ["Services.catalog.test"]
 
+ENVIRONMENT_HELP = ("ENVIRONMENT of the key, for files keyed by (NAME, "
+                    "ENVIRONMENT)")
+
+# Sidecar index saved next to each catalog, see CatalogIndex
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 3
+
+
+class CatalogIndex:
+    """Dict-backed index of a catalog file.
+
+    The key to offset map is kept in a pickled sidecar, <file>.idx, which
+    is used as long as the size and mtime of the file match the ones it
+    was saved with. Otherwise the file is parsed in a single read and the
+    sidecar is saved again. With a current sidecar, the fields of a row
+    are read by seeking to its offset, and the file is only read in full
+    when it is rewritten.
+
+    Files in COMPOSITE_KEY_FILES are keyed by a (NAME, ENVIRONMENT) tuple
+    of their first two columns, other files by their first column. A key
+    refers to the first row with that key; later rows with the same key
+    are kept in duplicates, and are only returned by offsets_by() and
+    inverted(). Changes to a key with duplicates are refused, see
+    require_unique().
+
+    Attributes:
+        header: List of column names, from the first line
+        columns: Dict of lower cased column name to position
+        key_length: Number of leading columns making up the key
+        rows: Dict of key to the byte offset of its row
+        duplicates: Dict of key to the offsets of later rows with that key
+        data: The file contents as bytes, used to rewrite the file around
+            a row without reading it again
+    """
+
+    def __init__(self, file, sidecar=True):
+        self.file = file
+        self.key_length = (2 if os.path.basename(file) in COMPOSITE_KEY_FILES
+                           else 1)
+        self._data = None
+        self._fields = {}
+        self._secondary = {}
+        self._inverted = {}
+        cached = load_sidecar(file) if sidecar else None
+        if cached is not None:
+            self.stat = cached["stat"]
+            self.header = cached["header"]
+            self.rows = cached["offsets"]
+            self.duplicates = cached["duplicates"]
+            self._inverted = cached["inverted"]
+        else:
+            self._parse()
+            if sidecar:
+                self.save()
+        self.columns = {column.lower(): i
+                        for i, column in enumerate(self.header)}
+
+    def _parse(self):
+        with open(self.file, 'rb') as infile:
+            self.stat = file_stat(infile.fileno())
+            self._data = infile.read()
+        self.rows = {}
+        self.duplicates = {}
+        self.header = []
+        offset = 0
+        for line in self._data.splitlines(keepends=True):
+            fields = split_line(line)
+            if offset == 0:
+                self.header = fields
+            else:
+                key = self.key(fields)
+                if key not in self.rows:
+                    self.rows[key] = offset
+                    self._fields[key] = fields
+                else:
+                    self.duplicates.setdefault(key, []).append(offset)
+            offset += len(line)
+
+    def key(self, fields):
+        """Returns the key of a row given as a list of values."""
+        if self.key_length == 1:
+            return fields[0]
+        return tuple((fields + [''])[:2])
+
+    @property
+    def data(self):
+        if self._data is None:
+            with open(self.file, 'rb') as infile:
+                self._data = infile.read()
+        return self._data
+
+    def save(self):
+        """Writes the sidecar index, via a temporary file and a rename."""
+        sidecar = {"version": INDEX_VERSION, "stat": self.stat,
+                   "header": self.header, "offsets": self.rows,
+                   "duplicates": self.duplicates,
+                   "inverted": self._inverted}
+        temp = self.file + INDEX_SUFFIX + ".tmp"
+        try:
+            with open(temp, 'wb') as outfile:
+                pickle.dump(sidecar, outfile, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, self.file + INDEX_SUFFIX)
+        except OSError:
+            # The sidecar is only a cache, e.g. the directory is read only
+            pass
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def line_at(self, offset):
+        """Returns the line starting at offset, as bytes."""
+        if self._data is None:
+            with open(self.file, 'rb') as infile:
+                infile.seek(offset)
+                return infile.readline()
+        end = self._data.find(b'\n', offset)
+        return self._data[offset:None if end == -1 else end + 1]
+
+    def lines_at(self, offsets):
+        """Yields the line starting at each of offsets, as bytes, opening
+        the file once."""
+        if self._data is not None:
+            for offset in offsets:
+                yield self.line_at(offset)
+            return
+        with open(self.file, 'rb') as infile:
+            for offset in offsets:
+                infile.seek(offset)
+                yield infile.readline()
+
+    def offsets(self):
+        """Returns the offsets of every row, duplicates included, in file
+        order."""
+        offsets = list(self.rows.values())
+        for duplicates in self.duplicates.values():
+            offsets.extend(duplicates)
+        return sorted(offsets)
+
+    def offsets_of(self, key):
+        """Returns the offsets of every row with key, in file order."""
+        return [self.rows[key]] + self.duplicates.get(key, [])
+
+    def fields(self, key):
+        """Returns the list of values for key."""
+        if key not in self._fields:
+            self._fields[key] = split_line(self.line_at(self.rows[key]))
+        return self._fields[key]
+
+    def offsets_by(self, position, value):
+        """Returns the offsets of every row, duplicates included, whose key
+        column at position equals value, in file order.
+
+        Backed by a secondary index on that key column, built from the keys
+        on first use, so e.g. all services in an ENVIRONMENT are found
+        without reading the file.
+        """
+        if position not in self._secondary:
+            secondary = {}
+            for key in self.rows:
+                part = key[position] if self.key_length > 1 else key
+                secondary.setdefault(part, []).extend(self.offsets_of(key))
+            for offsets in secondary.values():
+                offsets.sort()
+            self._secondary[position] = secondary
+        return self._secondary[position].get(value, [])
+
+    def inverted(self, position):
+        """Returns the inverted index of the column at position, a dict of
+        value to the offsets of every row, duplicates included, holding
+        that value.
+
+        Built on first use with one pass over the file, and saved in the
+        sidecar, so later queries on the column do not scan the file until
+        it changes.
+        """
+        if position not in self._inverted:
+            inverted = {}
+            offset = 0
+            for line in self.data.splitlines(keepends=True):
+                if offset:
+                    fields = split_line(line)
+                    value = fields[position] if position < len(fields) else ''
+                    inverted.setdefault(value, []).append(offset)
+                offset += len(line)
+            self._inverted[position] = inverted
+            self.save()
+        return self._inverted[position]
+
+    def splice(self, key, line=b''):
+        """Returns the file contents with the row for key replaced by line,
+        or removed if line is empty."""
+        offset = self.rows[key]
+        data = self.data
+        return data[:offset] + line + data[offset + len(self.line_at(offset)):]
+
+    def suggestions(self, key, limit=10):
+        """Returns up to limit keys whose NAME contains the NAME of key, for
+        error messages."""
+        name = key[0] if isinstance(key, tuple) else key
+        return [format_key(k) for k in self.rows
+                if name in (k[0] if isinstance(k, tuple) else k)][:limit]
+
+
+def format_key(key):
+    """Returns a key as it appears in the file, e.g. 'cayley|psh-w'."""
+    return '|'.join(key) if isinstance(key, tuple) else key
+
+
+def open_catalog(args):
+    """Returns the CatalogIndex of args.file, and the key given by args.key
+    and, for files in COMPOSITE_KEY_FILES, args.environment."""
+    if args.file not in PRIMARY_KEY_FILES + COMPOSITE_KEY_FILES:
+        print("Please provide a valid catalog filename.")
+        print("Valid files: {}".
+              format(PRIMARY_KEY_FILES + COMPOSITE_KEY_FILES))
+        exit(1)
+    index = CatalogIndex(args.file)
+    key = getattr(args, 'key', None)
+    environment = getattr(args, 'environment', None)
+    if index.key_length == 1:
+        if environment is not None:
+            print("-e/--environment only applies to {}, EXITING.".
+                  format(COMPOSITE_KEY_FILES))
+            exit(1)
+        return index, key
+    if key is None or environment is None:
+        return index, None
+    return index, (key, environment)
+
+
+def require_key(index, key, args):
+    """Exits unless key is complete, i.e. has an ENVIRONMENT in files
+    keyed by (NAME, ENVIRONMENT)."""
+    if key is None:
+        print("{} is keyed by {}, please provide -e/--environment, "
+              "EXITING.".format(args.file, index.header[:2]))
+        exit(1)
 
-def add(args):
-    """Adds new key row to file."""
 
-    if args.file in PRIMARY_KEY_FILES:
-        with open(args.file, 'r') as infile:
-            keys = get_keys(args.file)
+def require_unique(index, key, args):
+    """Exits if more than one row has key, listing the rows, as a change
+    could only apply to one of them."""
+    if key not in index.duplicates:
+        return
+    print("{} rows in {} have key '{}', EXITING.".
+          format(len(index.duplicates[key]) + 1, args.file, format_key(key)))
+    for line in index.lines_at(index.offsets_of(key)):
+        print("..." + line.decode().rstrip())
+    print("...Edit the file to keep only one of them first.")
+    exit(1)
 
-            if args.key in keys:
-                print("Provided key: '{}' already exists in {}, EXITING.".
-                      format(args.key, args.file))
-                exit(1)
-            infile.seek(0)
 
-            file_header_length = len(infile.readline().split('|'))
-            data = [''] * file_header_length
-            data[0] = args.key
-            data = '|'.join(data) + '\n'
-        with open(args.file, 'a') as infile:
-            infile.write(data)
-        print("Added '{}' to {}.".
-              format(args.key, args.file))
+def split_line(line):
+    """Returns the list of values in a catalog line, given as bytes."""
+    return line.decode().rstrip('\r\n').split('|')
 
-    elif args.file in COMPOSITE_KEY_FILES:
-        # TODO (achao): Handle composite key for Services.catalog
-        pass
 
-    else:
-        print("Please provide a valid catalog filename.")
-        print("Valid files: {}".
-              format(PRIMARY_KEY_FILES + COMPOSITE_KEY_FILES))
-        exit(1)
+def file_stat(file):
+    """Returns (size, mtime in ns) of a path or file descriptor."""
+    stat = os.stat(file)
+    return stat.st_size, stat.st_mtime_ns
 
 
-def read(args):
-    """Prints header and values for given key."""
+def load_sidecar(file):
+    """Returns the sidecar index saved for file, or None if there is none
+    or it is out of date."""
+    try:
+        with open(file + INDEX_SUFFIX, 'rb') as infile:
+            sidecar = pickle.load(infile)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if (not isinstance(sidecar, dict)
+            or sidecar.get("version") != INDEX_VERSION
+            or sidecar.get("stat") != file_stat(file)):
+        return None
+    return sidecar
 
-    if args.file in PRIMARY_KEY_FILES:
-        infile = open(args.file, 'r')
 
-        # Get list of keys from file and return cursor to start of file
-        keys = get_keys(args.file)
+def add(args):
+    """Adds new key row to file."""
 
-    # TODO (achao): Figure out what to do with duplicates
+    index, key = open_catalog(args)
+    require_key(index, key, args)
 
-    #    from collections import Counter
-    #    print(Counter(keys))
-    #    for key in list(Counter(keys)):
-    #        print(key, end="")
+    if key in index:
+        print("Provided key: '{}' already exists in {}, EXITING.".
+              format(format_key(key), args.file))
+        exit(1)
 
-        infile.seek(0)
+    data = [''] * len(index.header)
+    data[:index.key_length] = key if index.key_length > 1 else [key]
+    data = '|'.join(data) + '\n'
+    with open(args.file, 'a') as infile:
+        infile.write(data)
+    print("Added '{}' to {}.".
+          format(format_key(key), args.file))
 
-        # If optional key argument is not provided, print all lines of file
-        line = infile.readline()
-        if args.key is None:
-            while line:
+
+def read(args):
+    """Prints header and values for given key."""
+
+    index, key = open_catalog(args)
+
+    # If optional key argument is not provided, print all lines of file,
+    # or with only one of NAME or ENVIRONMENT, every row matching it
+    if key is None:
+        if args.key is None and getattr(args, 'environment', None) is None:
+            for line in index.data.decode().splitlines():
                 print(line.rstrip())
-                line = infile.readline()
-
-        # If optional key argument is provided, print out data product
-        # information line by line
-        elif args.key in keys:
-            headers = line.rstrip().split('|')
-            data_product_information_dict = dict.fromkeys(headers)
-
-            while line:
-                items = line.rstrip().split('|')
-                if args.key == items[0]:
-                    if len(items) == len(headers):
-                        for i, header in enumerate(headers):
-                            data_product_information_dict[header] = items[i]
-                    else:
-                        print("Number of headers and values do not match.")
-                line = infile.readline()
-
-            for key, value in data_product_information_dict.items():
-                print(f"{key:25} | {value:25}")
+            return
+        if args.key is not None:
+            offsets = index.offsets_by(0, args.key)
         else:
-            print("Please provide a valid key, EXITING.")
-            if args.key is not None:
-                print("...First 10 potential keys in {} with string '{}': {}".
-                      format(args.file, args.key,
-                             list(filter(lambda k: args.key in k, keys))[:10]))
+            offsets = index.offsets_by(1, args.environment)
+        if not offsets:
+            print("No rows found for {}, EXITING.".
+                  format(args.key or args.environment))
             exit(1)
-
-        infile.close()
-    elif args.file in COMPOSITE_KEY_FILES:
-        # TODO (achao): Handle composite key for Services.catalog
-        pass
+        print('|'.join(index.header))
+        for line in index.lines_at(offsets):
+            print(line.decode().rstrip())
+
+    # If optional key argument is provided, print out data product
+    # information line by line
+    elif key in index:
+        headers = index.header
+        data_product_information_dict = dict.fromkeys(headers)
+
+        items = index.fields(key)
+        if len(items) == len(headers):
+            for i, header in enumerate(headers):
+                data_product_information_dict[header] = items[i]
+        else:
+            print("Number of headers and values do not match.")
+
+        for header, value in data_product_information_dict.items():
+            print(f"{header:25} | {value:25}")
+        if key in index.duplicates:
+            print("...{} more row(s) with key '{}' in {} not shown.".
+                  format(len(index.duplicates[key]), format_key(key),
+                         args.file))
     else:
-        print("Please provide a valid catalog filename.")
-        print("Valid files: {}".
-              format(PRIMARY_KEY_FILES + COMPOSITE_KEY_FILES))
+        print("Please provide a valid key, EXITING.")
+        print("...First 10 potential keys in {} with string '{}': {}".
+              format(args.file, args.key, index.suggestions(key)))
         exit(1)
 
 
 def update(args):
     """Updates column values for specified file and key."""
 
-    if args.file in PRIMARY_KEY_FILES:
-
-        infile = open(args.file, 'r')
-        outfile = open(args.file + '.out', 'w')
+    # A. Index the file, confirm user provided key is valid
+    index, key = open_catalog(args)
+    require_key(index, key, args)
+    if key not in index:
+        print("Please provide a valid key, EXITING.")
+        print("...First 10 potential keys in {} with string '{}': {}".
+              format(args.file, args.key, index.suggestions(key)))
+        exit(1)
+    require_unique(index, key, args)
 
-        # A. Get list of keys from file, confirm user provided key is valid
-        keys = get_keys(args.file)
-        infile.seek(0)
-        if args.key not in keys:
-            print("Please provide a valid key, EXITING.")
-            if args.key is not None:
-                print("...First 10 potential keys in {} with string '{}': {}".
-                      format(args.file, args.key,
-                             list(filter(lambda k: args.key in k, keys))[:10]))
-            exit(1)
+    # B. Get dictionary of lower cased header to index from the index
+    header_dictionary = index.columns
 
-        # B. Get list of headers from file, store value and index in dictionary
-        header_list = infile.readline()
-        outfile.write(header_list)
-        header_dictionary = {}
-        for counter, value in enumerate(header_list.rstrip().split('|')):
-            header_dictionary[value.lower()] = counter
+    # C. Extract cols and vals from args, validate input, zip cols and vals
+    vals = args.cols_vals[1::2]
+    cols = [col.lower() for col in args.cols_vals[::2]]
 
-        # C. Extract cols and vals from args, validate input, zip cols and vals
-        vals = args.cols_vals[1::2]
-        cols = [col.lower() for col in args.cols_vals[::2]]
+    if len(vals) != len(cols):  # Confirm same number of columns and values
+        print("Number of columns and values do not match, EXITING.")
+        exit(1)
+    elif len(cols) != len(set(cols)):  # Confirm no duplicate columns
+        print("Duplicate columns provided, EXITING.")
+        exit(1)
+    else:  # Confirm no invalid columns
+        for col in cols:
+            if col not in header_dictionary.keys():
+                print(f"'{col}' is not a valid column, EXITING.")
+                print("Valid columns are:",
+                      list(header_dictionary.keys())[index.key_length:])
+                exit(1)
 
-        if len(vals) != len(cols):  # Confirm same number of columns and values
-            print("Number of columns and values do not match, EXITING.")
-            exit(1)
-        elif len(cols) != len(set(cols)):  # Confirm no duplicate columns
-            print("Duplicate columns provided, EXITING.")
-            exit(1)
-        else:  # Confirm no invalid columns
-            for col in cols:
-                if col not in header_dictionary.keys():
-                    print(f"'{col}' is not a valid column, EXITING.")
-                    print("Valid columns are:",
-                          list(header_dictionary.keys())[1:])
-                    exit(1)
-
-        cols_vals = zip(cols, vals)
-
-        # D. Iterate through each line in file
-        #       if provided key is found
-        #           iterate through provided cols_vals and update
-        line = infile.readline().lower()
-        while line:
-            items = line.split('|')
-            if args.key == items[0]:
-                for col_val in cols_vals:
-                    print("Updating column: {0} | value: {1} => {2}.".format(
-                        col_val[0].upper(),
-                        items[header_dictionary[col_val[0]]].rstrip(),
-                        col_val[1]))
-                    items[header_dictionary[col_val[0]]] = col_val[1]
-                if "\n" not in items[-1]:
-                    items[-1] += "\n"
-                outfile.write('|'.join(items))
-            else:
-                outfile.write(line)
-            line = infile.readline()
+    cols_vals = zip(cols, vals)
 
-        infile.close()
-        outfile.close()
+    # D. Look up the row for provided key, update provided cols_vals
+    #    and write the file with only that row replaced
+    items = list(index.fields(key))
+    for col_val in cols_vals:
+        print("Updating column: {0} | value: {1} => {2}.".format(
+            col_val[0].upper(),
+            items[header_dictionary[col_val[0]]],
+            col_val[1]))
+        items[header_dictionary[col_val[0]]] = col_val[1]
+    line = ('|'.join(items) + '\n').encode()
 
-    elif args.file in COMPOSITE_KEY_FILES:
-        # TODO (achao): Handle composite key for Services.catalog
-        pass
-    else:
-        print("Please provide a valid catalog filename.")
-        print("Valid files: {}".
-              format(PRIMARY_KEY_FILES + COMPOSITE_KEY_FILES))
-        exit(1)
+    with open(args.file + '.out', 'wb') as outfile:
+        outfile.write(index.splice(key, line))
 
 
 def delete(args):
     """Deletes a row based on key provided."""
 
-    if args.file in PRIMARY_KEY_FILES:
-        with open(args.file, 'r') as infile:
-            keys = get_keys(args.file)
+    index, key = open_catalog(args)
+    require_key(index, key, args)
 
-            if args.key not in keys:
-                print("Provided key: '{}' does not exist in {}, EXITING.".
-                      format(args.key, args.file))
-                exit(1)
-            lines = infile.readlines()
+    if key not in index:
+        print("Provided key: '{}' does not exist in {}, EXITING.".
+              format(format_key(key), args.file))
+        exit(1)
+    require_unique(index, key, args)
 
-        if input("Are you sure you want to delete '{}' from {}? (y/n) ".
-                 format(args.key, args.file)) != "y":
-            exit(1)
+    if input("Are you sure you want to delete '{}' from {}? (y/n) ".
+             format(format_key(key), args.file)) != "y":
+        exit(1)
+
+    # Spliced before the file is truncated, data may not be read yet
+    data = index.splice(key)
+    with open(args.file, 'wb') as infile:
+        infile.write(data)
+    print("Deleted '{}' from {}.".
+          format(format_key(key), args.file))
+
+
+def apply(args):
+    """Applies a file of add, update and delete changes in one rewrite."""
+
+    index, _ = open_catalog(args)
 
-        with open(args.file, 'w') as infile:
-            for line in lines:
-                if line.split('|')[0] != args.key:
-                    infile.write(line)
-        print("Deleted '{}' from {}.".
-              format(args.key, args.file))
+    # A. Read and validate every change before touching the file
+    changes = read_changes(args.changes)
+    rows, errors = plan_changes(index, changes)
+    if errors:
+        for error in errors:
+            print(error)
+        print("{} invalid change(s) in {}, nothing applied, EXITING.".
+              format(len(errors), args.changes))
+        exit(1)
+
+    # B. Confirm, then rewrite the file once
+    counts = {"add": 0, "update": 0, "delete": 0}
+    for key, fields in rows.items():
+        if fields is None:
+            counts["delete"] += 1
+        elif key in index:
+            counts["update"] += 1
+        else:
+            counts["add"] += 1
+    print("Changes to {}: {add} add(s), {update} update(s), "
+          "{delete} delete(s).".format(args.file, **counts))
+    if not args.yes and input("Apply them? (y/n) ") != "y":
+        exit(1)
+
+    rewrite(index, rows)
+    print("Applied {} change(s) to {}.".format(len(changes), args.file))
 
-    elif args.file in COMPOSITE_KEY_FILES:
-        # TODO (achao): Handle composite key for Services.catalog
-        pass
 
+def query(args):
+    """Prints rows matching column predicates, projected to columns or
+    counted by a column."""
+
+    index, _ = open_catalog(args)
+
+    # A. Parse predicates, COL=VALUE or COL!=VALUE
+    predicates = []
+    for predicate in args.predicates:
+        operator = '!=' if '!=' in predicate else '='
+        column, separator, value = predicate.partition(operator)
+        if not separator:
+            print("'{}' is not a COL=VALUE or COL!=VALUE predicate, "
+                  "EXITING.".format(predicate))
+            exit(1)
+        predicates.append((column_position(index, column), value,
+                           operator == '!='))
+
+    # B. Intersect the matching offsets from each column's inverted index,
+    #    the most selective equality first
+    def selectivity(predicate):
+        position, value, negate = predicate
+        return negate, len(index.inverted(position).get(value, []))
+
+    matched = None
+    for position, value, negate in sorted(predicates, key=selectivity):
+        offsets = set(index.inverted(position).get(value, []))
+        if negate:
+            if matched is None:
+                matched = set(index.offsets())
+            matched -= offsets
+        else:
+            matched = offsets if matched is None else matched & offsets
+    offsets = index.offsets() if matched is None else sorted(matched)
+
+    # C. Count by a column, or print the projected columns of each row
+    if args.group_by:
+        position = column_position(index, args.group_by)
+        value_of = {offset: value for value, rows
+                    in index.inverted(position).items() for offset in rows}
+        print("{}|COUNT".format(index.header[position]))
+        for value, count in Counter(value_of[offset]
+                                    for offset in offsets).most_common():
+            print("{}|{}".format(value, count))
+        return
+
+    if args.columns:
+        positions = [column_position(index, column)
+                     for column in args.columns.split(',')]
     else:
-        print("Please provide a valid catalog filename.")
-        print("Valid files: {}".
-              format(PRIMARY_KEY_FILES + COMPOSITE_KEY_FILES))
+        positions = range(len(index.header))
+    print('|'.join(index.header[position] for position in positions))
+    for line in index.lines_at(offsets):
+        fields = split_line(line)
+        print('|'.join(fields[position] if position < len(fields) else ''
+                       for position in positions))
+
+
+def column_position(index, column):
+    """Returns the position of a column, given in any case, exiting if it is
+    not in the header of index."""
+    if column.lower() not in index.columns:
+        print(f"'{column}' is not a valid column, EXITING.")
+        print("Valid columns are:", list(index.columns.keys()))
         exit(1)
+    return index.columns[column.lower()]
+
+
+def read_changes(file):
+    """Returns the changes in a .jsonl or .csv change file, as a list of
+    (line number, op, key, environment, dict of column to value).
+
+    A .jsonl line looks like {"op": "update", "key": "etp_mkt_flow",
+    "values": {"TYPE": "mirror"}}. A .csv file has the header
+    op,key,column,value and sets one column per line, column and value
+    being empty for a delete. Changes to files keyed by (NAME,
+    ENVIRONMENT) also need an "environment" field, or csv column.
+    """
+    changes = []
+    with open(file, 'r', newline='') as infile:
+        if file.endswith('.csv'):
+            for row in csv.DictReader(infile):
+                values = {}
+                if row.get('column'):
+                    values[row['column']] = row.get('value') or ''
+                changes.append((row.get('op'), row.get('key'),
+                                row.get('environment'), values))
+        else:
+            for line in infile:
+                if not line.strip():
+                    changes.append(None)
+                    continue
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    change = None
+                if (not isinstance(change, dict) or not isinstance(
+                        change.get('values', {}), dict)):
+                    # Reported as invalid by plan_changes()
+                    change = {}
+                changes.append((change.get('op'), change.get('key'),
+                                change.get('environment'),
+                                change.get('values', {})))
+    # Line numbers include the csv header
+    start = 2 if file.endswith('.csv') else 1
+    return [(number, *change)
+            for number, change in enumerate(changes, start) if change]
+
+
+def plan_changes(index, changes):
+    """Validates changes against the header and keys of index, in order.
+
+    Returns:
+        rows: Dict of key to the new list of values of the row, or to None
+            if the row is deleted. Keys not in index are new rows.
+        errors: List of messages, one per invalid change
+    """
+    rows = {}
+    errors = []
+    for number, op, key, environment, values in changes:
+        if index.key_length > 1 and key and environment:
+            key = (key, environment)
+        elif index.key_length > 1:
+            key = None
+        prefix = "line {}: '{}' {}".format(number, format_key(key), op)
+        if op not in ("add", "update", "delete") or not key:
+            errors.append("line {}: expected an add, update or delete with "
+                          "a key{}".format(number, " and an environment"
+                                           if index.key_length > 1 else ""))
+            continue
+        columns = [column.lower() for column in values]
+        invalid = [column for column in columns
+                   if index.columns.get(column, 0) < index.key_length]
+        if invalid:
+            errors.append("{}: {} not valid column(s), valid columns are: {}".
+                          format(prefix, invalid,
+                                 list(index.columns.keys())
+                                 [index.key_length:]))
+            continue
+        if any('|' in str(value) or '\n' in str(value)
+               for value in values.values()):
+            errors.append("{}: values may not contain '|' or newlines".
+                          format(prefix))
+            continue
+
+        exists = rows[key] is not None if key in rows else key in index
+        if op == "add":
+            if exists:
+                errors.append("{}: key already exists".format(prefix))
+                continue
+            fields = [''] * len(index.header)
+            fields[:index.key_length] = (key if index.key_length > 1
+                                         else [key])
+        elif not exists:
+            errors.append("{}: key does not exist".format(prefix))
+            continue
+        elif key in index.duplicates:
+            lines = [line.decode().rstrip()
+                     for line in index.lines_at(index.offsets_of(key))]
+            errors.append("{}: key is on {} rows, keep only one of them "
+                          "first: {}".format(prefix, len(lines), lines))
+            continue
+        elif op == "delete":
+            rows[key] = None
+            if key not in index:
+                del rows[key]
+            continue
+        else:
+            fields = list(rows[key] if key in rows else index.fields(key))
+            fields += [''] * (len(index.header) - len(fields))
+        for column, value in zip(columns, values.values()):
+            fields[index.columns[column]] = str(value)
+        rows[key] = fields
+    return rows, errors
+
+
+def rewrite(index, rows):
+    """Streams index.file into a temporary file with rows applied, then
+    renames it over index.file.
+
+    Rows mapped to None are dropped, other rows in the file are replaced
+    in place, and rows not in the file are appended in order.
+    """
+    replaced = {index.rows[key]: key for key in rows if key in index}
+    appended = [fields for key, fields in rows.items() if key not in index]
+    temp = index.file + ".tmp"
+    try:
+        with open(index.file, 'rb') as infile, open(temp, 'wb') as outfile:
+            offset = 0
+            newline = True
+            for line in infile:
+                key = replaced.get(offset)
+                offset += len(line)
+                if key is not None:
+                    if rows[key] is None:
+                        continue
+                    line = ('|'.join(rows[key]) + '\n').encode()
+                outfile.write(line)
+                newline = line.endswith(b'\n')
+            if appended and not newline:
+                outfile.write(b'\n')
+            for fields in appended:
+                outfile.write(('|'.join(fields) + '\n').encode())
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        shutil.copymode(index.file, temp)
+        os.replace(temp, index.file)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
 
 
 def get_keys(file):
-    """Returns keys for given file."""
-    if file in PRIMARY_KEY_FILES:
-        with open(file, "r") as infile:
-            keys = [line.split("|")[0] for line in infile.readlines()][1:]
-    return keys
+    """Returns keys for given file, (NAME, ENVIRONMENT) tuples for files in
+    COMPOSITE_KEY_FILES."""
+    return list(CatalogIndex(file).rows)
 
 
-def main():
-    """Main execution block."""
+def main(argv=None):
+    """Main execution block. `argv` defaults to sys.argv[1:]."""
 
     parser = argparse.ArgumentParser(
         prog='upcat',
@@ -249,6 +713,8 @@ def main():
         help="Updates column values for given file and key")
     parser_update.add_argument("file", help="filename to edit")
     parser_update.add_argument("key", help="primary key in provided file")
+    parser_update.add_argument(
+        "-e", "--environment", help=ENVIRONMENT_HELP)
     parser_update.add_argument("cols_vals", nargs="+",
                                help="column value pairs to edit | \
                                usage: [col1 val1 col2 val2 ...]")
@@ -262,6 +728,9 @@ def main():
     parser_read.add_argument(
         "-k", "--key", default=None, metavar='FOO',
         help="key in file to reference")
+    parser_read.add_argument(
+        "-e", "--environment", default=None,
+        help=ENVIRONMENT_HELP + ", or alone every row in ENVIRONMENT")
     parser_read.set_defaults(func=read)
 
     # Sub-command: Add
@@ -270,6 +739,8 @@ def main():
         help='Adds given to key to file')
     parser_read.add_argument("file", help="filename to append key row to")
     parser_read.add_argument("key", help="key in file to reference")
+    parser_read.add_argument(
+        "-e", "--environment", help=ENVIRONMENT_HELP)
     parser_read.set_defaults(func=add)
 
     # Sub-command: Delete
@@ -278,9 +749,40 @@ def main():
         help='Deletes row in file for given key')
     parser_read.add_argument("file", help="filename to delete key row from")
     parser_read.add_argument("key", help="key in file to reference")
+    parser_read.add_argument(
+        "-e", "--environment", help=ENVIRONMENT_HELP)
     parser_read.set_defaults(func=delete)
 
-    args = parser.parse_args(None if sys.argv[1:] else ['-h'])
+    # Sub-command: Apply
+    parser_apply = subparsers.add_parser(
+        'apply',
+        help='Applies a .jsonl or .csv file of changes to file at once')
+    parser_apply.add_argument("file", help="filename to apply changes to")
+    parser_apply.add_argument("changes",
+                              help="change file, see read_changes()")
+    parser_apply.add_argument("-y", "--yes", action="store_true",
+                              help="apply without asking for confirmation")
+    parser_apply.set_defaults(func=apply)
+
+    # Sub-command: Query
+    parser_query = subparsers.add_parser(
+        'query',
+        help='Prints rows matching COL=VALUE or COL!=VALUE predicates')
+    parser_query.add_argument("file", help="filename to query")
+    parser_query.add_argument("predicates", nargs="*", metavar="PREDICATE",
+                              help="e.g. TYPE=tsfact HAS_POLLER=y, all rows"
+                              " when none are given")
+    output = parser_query.add_mutually_exclusive_group()
+    output.add_argument("-c", "--columns",
+                        help="comma separated columns to print")
+    output.add_argument("-g", "--group-by", metavar="COLUMN",
+                        help="print the number of matching rows per value"
+                        " of COLUMN instead")
+    parser_query.set_defaults(func=query)
+
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv if argv else ['-h'])
     return args.func(args)
 
 